@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# Benchmarks tripmage on synthetic images, and compares against an earlier run:
+#     ./src/bench.py --save baseline.json
+#     ... change things ...
+#     ./src/bench.py --baseline baseline.json
+# Exits with status 1 if any case got slower (or hungrier) than the thresholds allow.
+
+import argparse
+import io
+import json
+import PIL.Image
+import random
+import sys
+import time
+import tracemalloc
+import tripmage
+
+BENCH_VERSION = 1
+
+# Varied one at a time, around the first entry of each.  (The full product would take all day.)
+SIZES = [(320, 240), (64, 48), (1280, 960)]
+MODES = ['RGB', 'L', 'RGBA', 'P']
+MARGINS = [0, 16]
+ENGINES = ['auto', 'scalar', 'numpy']
+REGISTRY_KEYS = {
+    'border': tripmage.REGISTRY_BORDER,
+    'interpolation': tripmage.REGISTRY_INTERPOLATION,
+    'colorspace': tripmage.REGISTRY_COLORSPACE,
+    'components': tripmage.REGISTRY_COMPONENTS,
+    'distortion': tripmage.REGISTRY_DISTORTION,
+}
+# Differences below these are noise, whatever the thresholds say:
+TIME_SLACK = 0.002
+MEMORY_SLACK = 1 << 20
+
+
+def make_case(name, size=SIZES[0], mode=MODES[0], margins=MARGINS[0], engine=ENGINES[0], **options):
+    options = dict(options, seed='bench', engine=engine,
+                   margins=dict(left=margins, top=margins, right=margins, bottom=margins))
+    return dict(name=name, size=size, mode=mode, options=options)
+
+
+def bench_cases(quick=False):
+    cases = [make_case('base')]
+    for size in SIZES[1:]:
+        if not quick or size[0] * size[1] <= SIZES[0][0] * SIZES[0][1]:
+            cases.append(make_case('size={}x{}'.format(*size), size=size))
+    for mode in MODES[1:]:
+        cases.append(make_case('mode={}'.format(mode), mode=mode))
+    for margins in MARGINS[1:]:
+        cases.append(make_case('margins={}'.format(margins), margins=margins))
+    for engine in ENGINES[1:]:
+        if engine != 'numpy' or tripmage.np is not None:
+            # The scalar engine is slow enough that anything larger would dominate the whole run:
+            size = SIZES[1] if engine == 'scalar' else SIZES[0]
+            cases.append(make_case('engine={}'.format(engine), engine=engine, size=size))
+    for key, registry in REGISTRY_KEYS.items():
+        for entry in sorted(registry):
+            cases.append(make_case('{}={}'.format(key, entry), **{key: entry}))
+    return cases
+
+
+def make_synthetic_image(size, mode):
+    # Noise, because flat images would be unrealistically cheap to encode.
+    rng = random.Random('bench {}x{}'.format(*size))
+    img = PIL.Image.frombytes('RGB', size, rng.randbytes(3 * size[0] * size[1]))
+    return img if mode == 'RGB' else img.convert(mode)
+
+
+def run_case(case, repeats):
+    # Returns the case's results: the best time of each stage over `repeats` runs, the peak memory
+    # of each stage, and the breakdown by `tripmage.Profile`.  Decoding starts from PNG, encoding ends in PNG.
+    stream = io.BytesIO()
+    make_synthetic_image(case['size'], case['mode']).save(stream, 'png')
+    png = stream.getvalue()
+
+    def run():
+        decoded = tripmage.read_input(io.BytesIO(png))
+        yield 'decode'
+        result = tripmage.render(decoded, tripmage.compile_options(case['options']))
+        yield 'render'
+        tripmage.encode_output(result, 'png')
+        yield 'encode'
+
+    seconds = dict()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for stage in run():
+            end = time.perf_counter()
+            seconds[stage] = min(seconds.get(stage, end - start), end - start)
+            start = time.perf_counter()
+
+    peak_bytes = dict()
+    tracemalloc.start()
+    try:
+        for stage in run():
+            current, peak = tracemalloc.get_traced_memory()
+            peak_bytes[stage] = peak
+            tracemalloc.reset_peak()
+    finally:
+        tracemalloc.stop()
+
+    with tripmage.Profile() as profile:
+        for _ in run():
+            pass
+
+    dst_w, dst_h = tripmage.output_size(case['size'], case['options'])
+    return dict(
+        size=list(case['size']),
+        mode=case['mode'],
+        options=case['options'],
+        seconds=seconds,
+        pixels_per_second=dst_w * dst_h / seconds['render'],
+        peak_bytes=peak_bytes,
+        stages={name: stats['pixels_per_second'] for name, stats in profile.report().items()},
+    )
+
+
+def compare(baseline, results, slowdown=1.25, memory_growth=1.25):
+    # Returns a list of (case name, what, baseline value, new value) for every regression beyond the thresholds.
+    # Cases that only one side has are ignored.
+    regressions = []
+    for name, result in results['cases'].items():
+        old = baseline['cases'].get(name)
+        if old is None:
+            continue
+        for stage, old_seconds in old['seconds'].items():
+            if result['seconds'][stage] > old_seconds * slowdown + TIME_SLACK:
+                regressions.append((name, stage + ' seconds', old_seconds, result['seconds'][stage]))
+        for stage, old_bytes in old['peak_bytes'].items():
+            if result['peak_bytes'][stage] > old_bytes * memory_growth + MEMORY_SLACK:
+                regressions.append((name, stage + ' peak bytes', old_bytes, result['peak_bytes'][stage]))
+    return regressions
+
+
+def run_bench(cases, repeats, report_file=sys.stderr):
+    results = dict(version=BENCH_VERSION, numpy=tripmage.np is not None, cases=dict())
+    print('{:<36} {:>12} {:>10} {:>10} {:>10}'.format('case', 'render Mpx/s', 'decode ms', 'encode ms', 'peak MB'),
+          file=report_file)
+    for case in cases:
+        result = run_case(case, repeats)
+        results['cases'][case['name']] = result
+        print('{:<36} {:>12.2f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            case['name'], result['pixels_per_second'] / 1e6, result['seconds']['decode'] * 1e3,
+            result['seconds']['encode'] * 1e3, max(result['peak_bytes'].values()) / (1 << 20)), file=report_file)
+    return results
+
+
+def run_argv(argv):
+    parser = argparse.ArgumentParser(prog=argv[0], description='Benchmark tripmage.')
+    parser.add_argument('--quick', action='store_true', help='Skip the largest sizes')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs per case; the fastest counts')
+    parser.add_argument('--filter', default='', help='Only run cases whose name contains this')
+    parser.add_argument('--save', metavar='FILE', help='Write the results in JSON, e.g. as a new baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare against the results in FILE')
+    parser.add_argument('--slowdown', type=float, default=1.25,
+                        help='With --baseline: Fail if any stage takes longer than this factor times the baseline')
+    parser.add_argument('--memory-growth', type=float, default=1.25,
+                        help='With --baseline: Fail if any stage needs more than this factor times the memory')
+    args = parser.parse_args(argv[1:])
+
+    cases = [case for case in bench_cases(args.quick) if args.filter in case['name']]
+    results = run_bench(cases, args.repeats)
+    if args.save is not None:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if baseline['version'] != BENCH_VERSION or baseline['numpy'] != results['numpy']:
+            print('Baseline is from a different setup, cannot compare.', file=sys.stderr)
+            exit(2)
+        regressions = compare(baseline, results, args.slowdown, args.memory_growth)
+        for name, what, old, new in regressions:
+            print('REGRESSION {}: {} went from {:.4g} to {:.4g}'.format(name, what, old, new), file=sys.stderr)
+        if regressions:
+            exit(1)
+        print('No regressions in {} cases.'.format(len(cases)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    run_argv(sys.argv)
@@ -1,8 +1,40 @@
 #!/usr/bin/env python3
 
+import bench
+import http.client
+import io
+import json
 import math
+import os
+import pickle
+import queue
+import PIL.Image
+import PIL.features
+import random
+import tempfile
+import threading
 import tripmage
 import unittest
+import urllib.parse
+
+
+def make_random_image(rng, w, h, mode='RGB'):
+    return PIL.Image.frombytes(mode, (w, h), bytes(rng.getrandbits(8) for _ in range(w * h * len(mode))))
+
+
+def distortion_wobble(x, y, w, h, ctx):
+    # Must live at module level, so that worker processes can find it.
+    return (math.sin(y / 3) * 2, math.cos(x / 2))
+
+
+def interpolate_average(col_ul, col_ur, col_bl, col_br, x_frac, y_frac, ctx):
+    return [(ul + ur + bl + br) // 4 for ul, ur, bl, br in zip(col_ul, col_ur, col_bl, col_br)]
+
+
+def components_alternating(x, y, w, h, ctx):
+    components = tripmage.components_staticrandom(x, y, w, h, ctx)
+    return components if (x + y) % 2 == 0 else components[::-1]
+
 
 class TestStringMethods(unittest.TestCase):
     def test_border_snap(self):
@@ -17,6 +49,33 @@ class TestStringMethods(unittest.TestCase):
                 x, y, w, h, a, b = xywhab
                 self.assertEqual(tripmage.border_snap(x, y, w, h, None), (a, b))
 
+    def test_border_wrap_mirror(self):
+        for x, y, w, h, wrapped, mirrored in [
+                (-1, -5, 10, 4, (9, 3), (1, 1)),
+                (12.5, 3, 10, 4, (2.5, 3), (5.5, 3)),
+                (-1e-20, 7, 10, 1, (0.0, 0), (0.0, 0)),
+                ]:
+            with self.subTest(x=x, y=y, w=w, h=h):
+                self.assertEqual(tripmage.border_wrap(x, y, w, h, None), wrapped)
+                self.assertEqual(tripmage.border_mirror(x, y, w, h, None), mirrored)
+                if tripmage.np is not None:
+                    self.assertEqual(tripmage.border_wrap_batch(tripmage.np.array([x]), y, w, h, None), wrapped)
+                    self.assertEqual(tripmage.border_mirror_batch(tripmage.np.array([x]), y, w, h, None), mirrored)
+
+    def test_interpolate_bilinear(self):
+        ul, ur, bl, br = [10, 0, 255], [20, 0, 0], [30, 0, 0], [40, 100, 0]
+        self.assertEqual(tripmage.interpolate_bilinear(ul, ur, bl, br, 0.0, 0.0, None), ul)
+        # The corners come in the order (x0, y0), (x0, y1), (x1, y0), (x1, y1):
+        self.assertEqual(tripmage.interpolate_bilinear(ul, ur, bl, br, 1.0, 0.0, None), bl)
+        self.assertEqual(tripmage.interpolate_bilinear(ul, ur, bl, br, 0.5, 0.5, None), [25, 25, 64])
+
+    def test_wrap_bilinear_seamless(self):
+        # Past the last pixel, wrapping blends towards the first one, like in the next tile:
+        img = tripmage.DecodedImage((2, 2), bytes([0, 0, 0, 10, 0, 0, 20, 0, 0, 30, 0, 0]))
+        for border, expected in [('wrap', (15, 0, 0)), ('snap', (30, 0, 0))]:
+            popopts = tripmage.populate_options(dict(border=border, interpolation='bilinear'))
+            self.assertEqual(tuple(tripmage.compute_rgb(img, 1.5, 1.5, popopts)), expected)
+
     def test_interpolate_nearest_neighbor(self):
         for x_frac, y_frac, expect in [
                 (0.00, 0.00, 'ul'),
@@ -126,6 +185,806 @@ class TestStringMethods(unittest.TestCase):
                 self.assertAlmostEqual(actual[2].scalar_prod(actual[1]), 0.0, delta=DELTA)
                 self.assertAlmostEqual(actual[2].scalar_prod(actual[2]), 1.0, delta=DELTA)
 
+    @unittest.skipIf(tripmage.np is None, 'NumPy not installed')
+    def test_engine_numpy_identical(self):
+        rng = random.Random('test_engine_numpy_identical')
+        for i in range(12):
+            w, h = rng.randint(1, 30), rng.randint(1, 20)
+            mode = rng.choice(['RGB', 'RGBA'])
+            options = dict(seed=str(i), margins=dict(top=rng.randint(0, 4), bottom=rng.randint(0, 4),
+                                                     left=rng.randint(0, 4), right=rng.randint(0, 4)))
+            if i % 3 == 0:
+                options['distortion'] = dict(type='static_random', scale_type='abs',
+                                             scale_x=rng.uniform(0, 20), scale_y=rng.uniform(0, 20))
+            if i % 4 == 0:
+                options['colorspace'] = dict(type='projected_gammacorrected', gamma=rng.choice([0.5, 1.0, 2.2]))
+            options['border'] = ['snap', 'wrap', 'mirror'][i % 3]
+            options['interpolation'] = ['nearest_neighbor', 'bilinear'][i // 2 % 2]
+            img = make_random_image(rng, w, h, mode)
+            with self.subTest(options=options, size=(w, h), mode=mode):
+                expected = tripmage.run_options_scalar(img, tripmage.populate_options(options))
+                actual = tripmage.run_options_numpy(img, tripmage.populate_options(options))
+                self.assertEqual(expected.size, actual.size)
+                self.assertEqual(expected.tobytes(), actual.tobytes())
+
+    def test_engine_fallback(self):
+        def distortion_custom(x, y, w, h, ctx):
+            return (x % 3 - 1.0, y % 2 * 0.5)
+
+        options = dict(seed='fallback', engine='numpy', distortion_2=dict(type='static_random', fn=distortion_custom))
+        popopts = tripmage.populate_options(options)
+        self.assertNotIn('fn_batch', popopts['distortion_2'])
+        self.assertIn('fn_batch', popopts['distortion_3'])
+        img = make_random_image(random.Random('test_engine_fallback'), 9, 7)
+        expected = tripmage.run_options_scalar(img, tripmage.populate_options(options))
+        if tripmage.np is None:
+            with self.assertRaises(ValueError):
+                tripmage.run_options(img, popopts)
+        else:
+            self.assertEqual(tripmage.run_options(img, popopts).tobytes(), expected.tobytes())
+
+    @unittest.skipIf(tripmage.np is None, 'NumPy not installed')
+    def test_batch_elementwise_fallback(self):
+        rng = random.Random('test_batch_elementwise_fallback')
+        img = make_random_image(rng, 13, 11)
+        options = dict(seed='no batch', margins=dict(top=2, bottom=1, left=0, right=3))
+        expected = tripmage.run_options_scalar(img, tripmage.populate_options(options))
+        popopts = tripmage.populate_options(options)
+        for ctx in popopts.values():
+            if isinstance(ctx, dict):
+                for name in [name for name in ctx if name.endswith('_batch')]:
+                    del ctx[name]
+        old_batch_pixels = tripmage.BATCH_PIXELS
+        try:
+            tripmage.BATCH_PIXELS = 40  # Force several bands
+            actual = tripmage.run_options_numpy(img, popopts)
+        finally:
+            tripmage.BATCH_PIXELS = old_batch_pixels
+        self.assertEqual(expected.tobytes(), actual.tobytes())
+
+    @unittest.skipIf(tripmage.np is None, 'NumPy not installed')
+    def test_border_snap_batch(self):
+        np = tripmage.np
+        xs = np.array([-5, 15, 15, 30, 4, 2.5])
+        ys = np.array([-5, 15, 15, 30, 2, 7.5])
+        ws = np.array([10, 10, 20, 20, 8, 3])
+        hs = np.array([10, 10, 10, 40, 7, 8])
+        actual_x, actual_y = tripmage.border_snap_batch(xs, ys, ws, hs, None)
+        for i in range(len(xs)):
+            self.assertEqual(tripmage.border_snap(xs[i], ys[i], ws[i], hs[i], None), (actual_x[i], actual_y[i]))
+
+    @unittest.skipIf(tripmage.np is None, 'NumPy not installed')
+    def test_constant_offsets_detection(self):
+        popopts = tripmage.populate_options(dict(seed='constant'))
+        self.assertIsNotNone(tripmage.constant_offsets(popopts, 10, 10))
+
+        def distortion_varying_batch(x, y, w, h, ctx):
+            return (x * 0.5, y * 0.0)
+
+        popopts = tripmage.populate_options(dict(seed='varying', distortion_1=dict(
+            type='static_random', fn=None, fn_batch=distortion_varying_batch)))
+        self.assertIsNone(tripmage.constant_offsets(popopts, 10, 10))
+
+    @unittest.skipIf(tripmage.np is None, 'NumPy not installed')
+    def test_constant_offsets_identical(self):
+        rng = random.Random('test_constant_offsets_identical')
+        for i in range(10):
+            w, h = rng.randint(1, 25), rng.randint(1, 25)
+            scale = rng.choice([0.5, 3, 40])
+            options = dict(seed=str(i), margins=dict(top=rng.randint(0, 6), bottom=rng.randint(0, 6),
+                                                     left=rng.randint(0, 6), right=rng.randint(0, 6)),
+                           distortion=dict(type='static_random', scale_type='abs', scale_x=scale, scale_y=scale))
+            img = make_random_image(rng, w, h)
+            with self.subTest(options=options, size=(w, h)):
+                popopts = tripmage.populate_options(options)
+                self.assertIsNotNone(tripmage.constant_offsets(popopts, w, h))
+                expected = tripmage.run_options_scalar(img, tripmage.populate_options(options))
+                old_batch_pixels = tripmage.BATCH_PIXELS
+                try:
+                    tripmage.BATCH_PIXELS = 50  # Force several bands
+                    actual = tripmage.run_options_numpy(img, popopts)
+                finally:
+                    tripmage.BATCH_PIXELS = old_batch_pixels
+                self.assertEqual(expected.tobytes(), actual.tobytes())
+
+    def test_color_projgamma_tables_exact(self):
+        # The table-driven conversions must agree with the plain formulas, bit by bit.
+        def rgb2col_formula(r, g, b, gamma):
+            col = tripmage.Color([(c / 255) ** gamma * 2 - 1 for c in [r, g, b]])
+            max_component = max(abs(c) for c in col.abc)
+            if max_component < 1e-4:
+                return col.abc
+            return col.scale(max_component / col.vec_length()).abc
+
+        def col2rgb_formula(col, gamma):
+            max_component = max(abs(c) for c in col.abc)
+            if max_component >= 1e-4:
+                col = col.scale(col.vec_length() / max_component)
+            rgb = [min(max(0.0, c / 2 + 0.5), 1.0) ** (1 / gamma) * 255 for c in col.abc]
+            return [min(max(0, round(c)), 255) for c in rgb]
+
+        rng = random.Random('test_color_projgamma_tables_exact')
+        for gamma in [0.1, 0.6, 1, 2, 2.2, 2.4]:
+            ctx = dict(gamma=gamma)
+            with self.subTest(gamma=gamma):
+                for c in range(256):
+                    rgb = (c, rng.randrange(256), 255 - c)
+                    self.assertEqual(tripmage.color_projgamma_rgb2col(*rgb, ctx).abc, rgb2col_formula(*rgb, gamma))
+                for _ in range(2000):
+                    col = tripmage.Color.make_random_unit(rng).scale(rng.random())
+                    self.assertEqual(tripmage.color_projgamma_col2rgb(col, ctx), col2rgb_formula(col, gamma))
+                    # Points that are exactly on a table entry are the interesting ones:
+                    col = tripmage.color_projgamma_rgb2col(rng.randrange(256), rng.randrange(256), rng.randrange(256), ctx)
+                    self.assertEqual(tripmage.color_projgamma_col2rgb(col, ctx), col2rgb_formula(col, gamma))
+                self.assertIs(tripmage.gamma_table(gamma), tripmage.gamma_table(gamma))
+
+    def test_decoded_image_modes(self):
+        rgb = PIL.Image.new('RGB', (3, 2))
+        rgb.putdata([(0, 0, 0), (255, 0, 0), (0, 128, 0), (1, 2, 3), (200, 100, 50), (255, 255, 255)])
+        for img in [rgb, rgb.convert('RGBA'), rgb.convert('P', palette=PIL.Image.Palette.ADAPTIVE)]:
+            with self.subTest(mode=img.mode):
+                decoded = tripmage.DecodedImage.from_image(img)
+                self.assertEqual(decoded.size, (3, 2))
+                self.assertEqual(decoded.data, rgb.tobytes())
+        gray = PIL.Image.new('L', (2, 1))
+        gray.putdata([7, 250])
+        for mode in ['L', 'LA']:
+            with self.subTest(mode=mode):
+                decoded = tripmage.DecodedImage.from_image(gray.convert(mode))
+                self.assertEqual(decoded.data, bytes([7, 7, 7, 250, 250, 250]))
+        deep = PIL.Image.new('I;16', (2, 1))
+        deep.putpixel((0, 0), 40000)
+        deep.putpixel((1, 0), 200)
+        decoded = tripmage.DecodedImage.from_image(deep)
+        self.assertEqual(decoded.data, bytes([156, 156, 156, 0, 0, 0]))
+        self.assertIs(tripmage.DecodedImage.from_image(decoded), decoded)
+
+    def test_read_rgb(self):
+        img = make_random_image(random.Random('test_read_rgb'), 5, 4, 'RGBA')
+        decoded = tripmage.DecodedImage.from_image(img)
+        for y in range(4):
+            for x in range(5):
+                self.assertEqual(tripmage.read_rgb(decoded, x, y), img.getpixel((x, y))[:3])
+
+    def test_run_options_grayscale(self):
+        img = make_random_image(random.Random('test_run_options_grayscale'), 6, 5, 'L')
+        popopts = tripmage.populate_options(dict(seed='gray', engine='scalar'))
+        expected = tripmage.run_options(img.convert('RGB'), popopts)
+        self.assertEqual(tripmage.run_options(img, popopts).tobytes(), expected.tobytes())
+
+    def test_output_formats(self):
+        img = make_random_image(random.Random('test_output_formats'), 7, 3)
+        result = tripmage.render(img, tripmage.populate_options(dict(seed='formats', engine='scalar')))
+        self.assertEqual(result.to_image().tobytes(), result.tobytes())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for output_format in ['raw', 'ppm', 'auto']:
+                with self.subTest(output_format=output_format):
+                    filename = os.path.join(tmpdir, 'out.' + ('png' if output_format == 'auto' else output_format))
+                    tripmage.write_output(result, filename, output_format)
+                    if output_format == 'raw':
+                        reread = tripmage.read_input(filename, raw_size=(7, 3))
+                    else:
+                        reread = tripmage.read_input(filename)
+                    self.assertEqual(reread.size, (7, 3))
+                    self.assertEqual(reread.tobytes(), result.tobytes())
+            with open(os.path.join(tmpdir, 'out.ppm'), 'rb') as fp:
+                self.assertTrue(fp.read().startswith(b'P6\n7 3\n255\n'))
+
+    @unittest.skipIf(tripmage.np is None, 'NumPy not installed')
+    def test_render_numpy_no_copy(self):
+        img = tripmage.DecodedImage.from_image(make_random_image(random.Random('test_render_numpy_no_copy'), 5, 5))
+        result = tripmage.run_options_numpy(img, tripmage.populate_options(dict(seed='no copy')))
+        self.assertIsInstance(result.data, memoryview)
+        self.assertEqual(result.array().shape, (5, 5, 3))
+
+    def test_render_parallel_identical(self):
+        rng = random.Random('test_render_parallel_identical')
+        img = make_random_image(rng, 17, 13)
+        engines = ['scalar'] if tripmage.np is None else ['scalar', 'numpy']
+        for engine in engines:
+            for distortion in ['static_random', dict(type='static_random', fn=distortion_wobble)]:
+                options = dict(seed='parallel', engine=engine, distortion_3=distortion,
+                               margins=dict(top=3, bottom=2, left=1, right=4))
+                with self.subTest(engine=engine, distortion=distortion):
+                    expected = tripmage.render(img, tripmage.populate_options(options))
+                    popopts = tripmage.populate_options(options)
+                    actual = tripmage.render(img, popopts, jobs=3)
+                    self.assertEqual(actual.size, expected.size)
+                    self.assertEqual(actual.tobytes(), expected.tobytes())
+                    # Resolved in the parent:
+                    self.assertIn('_cache', popopts['distortion_1'])
+                    self.assertIn('_cache', popopts['components'])
+
+
+    def test_render_animation(self):
+        rng = random.Random('test_render_animation')
+        img = make_random_image(rng, 11, 9)
+        base = dict(seed='anim', colorspace=dict(type='projected_gammacorrected', gamma=2.2))
+        frame_options = [dict(seed='anim {}'.format(i),
+                              distortion=dict(type='static_random', scale_type='abs', scale_x=i, scale_y=i))
+                         for i in range(4)]
+        engines = ['scalar'] if tripmage.np is None else ['scalar', 'numpy']
+        for engine in engines:
+            with self.subTest(engine=engine):
+                base['engine'] = engine
+                frames = list(tripmage.render_animation(img, base, frame_options))
+                self.assertEqual(len(frames), 4)
+                for frame, overrides in zip(frames, frame_options):
+                    options = dict(base)
+                    options.update(overrides)
+                    expected = tripmage.render(img, tripmage.populate_options(options))
+                    self.assertEqual(frame.tobytes(), expected.tobytes())
+
+    @unittest.skipIf(tripmage.np is None, 'requires numpy')
+    def test_colorspace_plane_reused(self):
+        rng = random.Random('test_colorspace_plane_reused')
+        img = tripmage.DecodedImage.from_image(make_random_image(rng, 8, 6))
+        for seed in ['a', 'b', 'c']:
+            popopts = tripmage.populate_options(dict(seed=seed))
+            img.keep_colorspace_plane(popopts)
+            self.assertEqual(len(img.colorspace_planes), 1)
+            # Uses the kept plane; must not change anything:
+            expected = tripmage.render(tripmage.DecodedImage(img.size, img.data), popopts)
+            self.assertEqual(tripmage.render(img, popopts).tobytes(), expected.tobytes())
+        img.keep_colorspace_plane(tripmage.populate_options(dict(colorspace=dict(type='projected_gammacorrected', gamma=1.8))))
+        self.assertEqual(len(img.colorspace_planes), 2)
+
+    def test_colorspace_plane_converts_once(self):
+        img = tripmage.DecodedImage.from_image(make_random_image(random.Random('test_colorspace_plane_converts_once'), 8, 6))
+        options = dict(seed='once', distortion_2=dict(type='static_random', fn=distortion_wobble))
+        engines = ['scalar'] if tripmage.np is None else ['scalar', 'numpy']
+        for engine in engines:
+            with self.subTest(engine=engine), tripmage.Profile() as profile:
+                tripmage.render(img, tripmage.compile_options(dict(options, engine=engine)))
+                stats = profile.report()
+                conversions = sum(stats[name]['pixels'] for name in stats if name.startswith('colorspace:') and '.rgb_to_col' in name)
+                self.assertLessEqual(conversions, 8 * 6)
+        if tripmage.np is not None:
+            # Kept for the next render, e.g. with another seed:
+            self.assertEqual(len(img.colorspace_planes), 1)
+        # Above the size limit, each sample is converted on its own, with the same result:
+        popopts = tripmage.compile_options(dict(options, engine='scalar'))
+        expected = tripmage.render(img, popopts).tobytes()
+        original = tripmage.COLORSPACE_PLANE_MAX_PIXELS
+        tripmage.COLORSPACE_PLANE_MAX_PIXELS = 8 * 6 - 1
+        try:
+            with tripmage.Profile() as profile:
+                self.assertEqual(tripmage.render(img, tripmage.compile_options(dict(options, engine='scalar'))).tobytes(), expected)
+            self.assertGreater(profile.report()['compute_rgb_bound']['calls'], 0)
+        finally:
+            tripmage.COLORSPACE_PLANE_MAX_PIXELS = original
+
+    def test_write_animation_gif(self):
+        rng = random.Random('test_write_animation_gif')
+        img = make_random_image(rng, 10, 7)
+        frame_options = [dict(seed='gif {}'.format(i)) for i in range(3)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'anim.gif')
+            tripmage.write_animation(tripmage.render_animation(img, dict(), frame_options), path, duration=70)
+            with PIL.Image.open(path) as gif:
+                self.assertEqual(gif.n_frames, 3)
+                self.assertEqual(gif.size, (10, 7))
+                self.assertEqual(gif.info['duration'], 70)
+                self.assertEqual(gif.info['loop'], 0)
+
+    def test_write_animation_apng_webp(self):
+        rng = random.Random('test_write_animation_apng_webp')
+        img = make_random_image(rng, 10, 7)
+        frame_options = [dict(seed='anim {}'.format(i)) for i in range(3)]
+        names = ['anim.png', 'anim.apng']
+        if PIL.features.check('webp'):
+            names.append('anim.webp')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in names:
+                with self.subTest(name=name):
+                    path = os.path.join(tmpdir, name)
+                    tripmage.write_animation(tripmage.render_animation(img, dict(), frame_options), path, duration=70)
+                    with PIL.Image.open(path) as anim:
+                        self.assertEqual(anim.n_frames, 3)
+                        self.assertEqual(anim.size, (10, 7))
+
+    @unittest.skipIf(tripmage.np is None, 'requires numpy')
+    def test_gather_map_identical(self):
+        rng = random.Random('test_gather_map_identical')
+        frames = [make_random_image(rng, 13, 9) for _ in range(3)]
+        variants = [
+            dict(),
+            dict(distortion_2=dict(type='static_random', fn=distortion_wobble)),
+            dict(interpolation=dict(type='nearest_neighbor', fn=interpolate_average)),
+            dict(components=dict(type='static_random', fn=components_alternating)),
+            dict(components=dict(type='static_random', fn=components_alternating),
+                 interpolation=dict(type='nearest_neighbor', fn=interpolate_average),
+                 distortion=dict(type='static_random', fn=distortion_wobble)),
+            dict(interpolation='bilinear', border='wrap'),
+            dict(interpolation='bilinear', border='mirror', distortion=dict(type='static_random', fn=distortion_wobble)),
+        ]
+        for variant in variants:
+            options = dict(seed='gather', margins=dict(top=2, bottom=1, left=3, right=0), **variant)
+            with self.subTest(options=options):
+                popopts = tripmage.populate_options(options)
+                gather_map = tripmage.GatherMap(popopts, frames[0].size)
+                for frame in frames:
+                    expected = tripmage.render(frame, tripmage.populate_options(dict(options, engine='scalar')))
+                    self.assertEqual(gather_map.render(frame).tobytes(), expected.tobytes())
+
+    def test_render_sequence(self):
+        rng = random.Random('test_render_sequence')
+        frames = [make_random_image(rng, 40, 30) for _ in range(2)] + [make_random_image(rng, 12, 20)]
+        options = dict(seed='sequence')
+        results = list(tripmage.render_sequence(frames, tripmage.populate_options(options)))
+        self.assertEqual(len(results), 3)
+        for frame, result in zip(frames, results):
+            # Freshly populated for each frame, so that nothing carries over from other sizes:
+            expected = tripmage.render(frame, tripmage.populate_options(options))
+            self.assertEqual(result.tobytes(), expected.tobytes())
+
+    def test_y4m_roundtrip(self):
+        rng = random.Random('test_y4m_roundtrip')
+        img = tripmage.DecodedImage.from_image(make_random_image(rng, 5, 3))
+        for chroma in ['444', '420jpeg', 'mono']:
+            with self.subTest(chroma=chroma):
+                y4m = tripmage.Y4MFormat('YUV4MPEG2 W5 H3 F25:1 Ip A1:1 C{}\n'.format(chroma).encode())
+                stream = io.BytesIO()
+                stream.write(y4m.header((5, 3)))
+                y4m.write_frame(img, stream)
+                y4m.write_frame(img, stream)
+                stream.seek(0)
+                read_back = tripmage.Y4MFormat(stream.readline())
+                self.assertEqual(read_back.size, (5, 3))
+                frames = list(read_back.read_frames(stream))
+                self.assertEqual(len(frames), 2)
+                self.assertEqual(frames[0].size, (5, 3))
+                if chroma == '444':
+                    # Only rounding errors from the conversions:
+                    for a, b in zip(frames[0].data, img.data):
+                        self.assertLessEqual(abs(a - b), 6)
+
+
+    def test_pipeline_json_roundtrip(self):
+        rng = random.Random('test_pipeline_json_roundtrip')
+        img = make_random_image(rng, 9, 7)
+        variants = [
+            dict(),
+            dict(seed='json', colorspace=dict(type='projected_gammacorrected', gamma=1.7),
+                 margins=dict(top=1, left=2)),
+            dict(seed='json', distortion_2=dict(type='static_random', fn=distortion_wobble), engine='scalar'),
+        ]
+        for variant in variants:
+            with self.subTest(variant=variant):
+                pipeline = tripmage.compile_options(variant)
+                text = pipeline.to_json()
+                self.assertNotIn('<function', text)
+                again = tripmage.Pipeline.from_json(text)
+                self.assertEqual(again.to_json(), text)
+                self.assertEqual(tripmage.render(img, again).tobytes(), tripmage.render(img, pipeline).tobytes())
+                if 'distortion_2' in variant:
+                    self.assertIs(again['distortion_2']['fn'], distortion_wobble)
+                    self.assertNotIn('fn_batch', again['distortion_2'])
+
+    def test_pipeline_sizes(self):
+        # A Pipeline must not carry anything over from one input size to the next:
+        rng = random.Random('test_pipeline_sizes')
+        imgs = [make_random_image(rng, 64, 48), make_random_image(rng, 20, 15), make_random_image(rng, 64, 48)]
+        engines = ['scalar'] if tripmage.np is None else ['scalar', 'numpy']
+        for engine in engines:
+            with self.subTest(engine=engine):
+                options = dict(seed='sizes', engine=engine)
+                pipeline = tripmage.compile_options(options)
+                for img in imgs:
+                    expected = tripmage.render(img, tripmage.compile_options(options))
+                    self.assertEqual(tripmage.render(img, pipeline).tobytes(), expected.tobytes())
+
+    def test_pipeline_pickle(self):
+        rng = random.Random('test_pipeline_pickle')
+        img = make_random_image(rng, 8, 5)
+        pipeline = tripmage.compile_options(dict(seed='pickle', engine='scalar'))
+        expected = tripmage.render(img, pipeline).tobytes()
+        copied = pickle.loads(pickle.dumps(pipeline))
+        self.assertIsInstance(copied, tripmage.Pipeline)
+        self.assertEqual(tripmage.render(img, copied).tobytes(), expected)
+        self.assertEqual(dict(copied)['seed'], 'pickle')
+        with self.assertRaises(AttributeError):
+            pipeline.border = None
+        with self.assertRaises(TypeError):
+            pipeline['seed'] = 'other'
+
+
+    @unittest.skipIf(tripmage.np is None, 'requires numpy')
+    def test_color_array_identical(self):
+        rng = random.Random('test_color_array_identical')
+        lhs = [tripmage.Color([rng.uniform(-2, 2) for _ in range(3)]) for _ in range(50)]
+        rhs = [tripmage.Color([rng.uniform(-2, 2) for _ in range(3)]) for _ in range(50)]
+        lhs_array = tripmage.ColorArray(tuple(tripmage.np.array(c) for c in zip(*[col.abc for col in lhs])))
+        rhs_array = tripmage.ColorArray(tuple(tripmage.np.array(c) for c in zip(*[col.abc for col in rhs])))
+        self.assertEqual(lhs_array.abc.shape, (3, 50))
+        checks = [
+            ('vec_length', lambda l, r: l.vec_length()),
+            ('scalar_prod', lambda l, r: l.scalar_prod(r)),
+            ('clip_length', lambda l, r: l.clip_length(1)),
+            ('scale', lambda l, r: l.scale(0.3)),
+            ('add', lambda l, r: l + r),
+            ('pointwise_prod', lambda l, r: l.pointwise_prod(r)),
+            ('cross_prod', lambda l, r: l.cross_prod(r)),
+        ]
+        for name, check in checks:
+            with self.subTest(name=name):
+                expected = [check(l, r) for l, r in zip(lhs, rhs)]
+                actual = check(lhs_array, rhs_array)
+                if isinstance(expected[0], tripmage.Color):
+                    self.assertEqual(actual.abc.T.tolist(), [list(c.abc) for c in expected])
+                else:
+                    self.assertEqual(actual.tolist(), expected)
+        self.assertEqual(lhs_array[10:20].abc.shape, (3, 10))
+        self.assertFalse(hasattr(lhs[0], '__dict__'))
+
+
+    def test_render_service(self):
+        rng = random.Random('test_render_service')
+        img = make_random_image(rng, 12, 8)
+        stream = io.BytesIO()
+        img.save(stream, format='PNG')
+        options = json.dumps(dict(seed='service', margins=dict(left=2)))
+        expected = tripmage.render(img, tripmage.compile_options(json.loads(options)))
+
+        service = tripmage.RenderService(workers=2, queue_size=4)
+        try:
+            for _ in range(3):
+                ppm = service.render(options, stream.getvalue(), 'ppm')
+                self.assertEqual(ppm, b'P6\n14 8\n255\n' + expected.tobytes())
+            with self.assertRaises(json.JSONDecodeError):
+                service.render('{', stream.getvalue())
+            # Clients must not make the server import things:
+            with self.assertRaises(ValueError):
+                service.render(json.dumps(dict(border=dict(type='snap', fn='tests:distortion_wobble'))), stream.getvalue())
+            stats = service.stats()
+            self.assertEqual(stats['jobs'], dict(done=3, failed=2, rejected=0))
+            self.assertEqual(stats['cache']['input_misses'], 1)
+            self.assertEqual(stats['cache']['input_hits'], 2)
+            self.assertEqual(stats['cache']['pipeline_misses'], 3)
+            self.assertIsNotNone(stats['latency_ms'])
+        finally:
+            service.close()
+
+    def test_render_service_sizes(self):
+        # The same options for inputs of different sizes; each must look like a fresh render:
+        rng = random.Random('test_render_service_sizes')
+        options = json.dumps(dict(seed='sizes'))
+        service = tripmage.RenderService(workers=1, queue_size=4)
+        try:
+            for img in [make_random_image(rng, 64, 48), make_random_image(rng, 20, 15)]:
+                stream = io.BytesIO()
+                img.save(stream, format='PNG')
+                expected = tripmage.render(img, tripmage.compile_options(json.loads(options)))
+                self.assertEqual(service.render(options, stream.getvalue(), 'raw'), expected.tobytes())
+            with self.assertRaises(ValueError):
+                service.max_pixels = 100
+                service.render(options, stream.getvalue() + b' ', 'raw')
+        finally:
+            service.close()
+
+    def test_lru_cache_weights(self):
+        cache = tripmage.LRUCache(10, weigh=len)
+        for key in ['aaaa', 'bbbb', 'cc', 'dddd']:
+            self.assertEqual(cache.get(key, lambda: key), key)
+        self.assertEqual(list(cache.entries), ['bbbb', 'cc', 'dddd'])
+        self.assertEqual(cache.weight, 10)
+        cache.get('eeeeeeeeeee', lambda: 'eeeeeeeeeee')
+        self.assertEqual(list(cache.entries), [])
+        self.assertEqual(cache.weight, 0)
+
+    def test_render_service_queue_bounded(self):
+        # Without workers, nothing leaves the queue:
+        service = tripmage.RenderService(workers=0, queue_size=2)
+        service.submit('{}', b'')
+        service.submit('{}', b'')
+        with self.assertRaises(queue.Full):
+            service.submit('{}', b'')
+        stats = service.stats()
+        self.assertEqual(stats['queue_depth'], 2)
+        self.assertEqual(stats['jobs']['rejected'], 1)
+
+    def test_render_server(self):
+        rng = random.Random('test_render_server')
+        img = make_random_image(rng, 10, 6)
+        stream = io.BytesIO()
+        img.save(stream, format='PNG')
+        options = json.dumps(dict(seed='server'))
+        expected = tripmage.render(img, tripmage.compile_options(json.loads(options)))
+
+        service = tripmage.RenderService(workers=1, queue_size=4)
+        server = tripmage.make_server('127.0.0.1:0', service, quiet=True, max_upload=len(stream.getvalue()))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            connection = http.client.HTTPConnection(*server.server_address[:2])
+            query = urllib.parse.urlencode(dict(options=options, format='raw'))
+            connection.request('POST', '/render?' + query, body=stream.getvalue())
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.read(), expected.tobytes())
+
+            connection.request('POST', '/render?options=%7B', body=stream.getvalue())
+            response = connection.getresponse()
+            response.read()
+            self.assertEqual(response.status, 400)
+
+            # Clients cannot import things, nor make jobs arbitrarily large or slow:
+            for bad_options in [dict(border=dict(type='snap', fn='this:i')),
+                                dict(margins=dict(right=20000, bottom=3000)),
+                                dict(engine='scalar')]:
+                query = urllib.parse.urlencode(dict(options=json.dumps(bad_options)))
+                connection.request('POST', '/render?' + query, body=stream.getvalue())
+                response = connection.getresponse()
+                response.read()
+                self.assertEqual(response.status, 400, bad_options)
+
+            connection.request('POST', '/render', body=stream.getvalue() + b' ')
+            response = connection.getresponse()
+            response.read()
+            self.assertEqual(response.status, 413)
+
+            connection.request('GET', '/stats')
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            stats = json.loads(response.read())
+            self.assertEqual(stats['jobs'], dict(done=1, failed=4, rejected=0))
+            self.assertEqual(stats['queue_depth'], 0)
+            connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            service.close()
+
+
+    def test_render_cache(self):
+        rng = random.Random('test_render_cache')
+        img = tripmage.DecodedImage.from_image(make_random_image(rng, 9, 6))
+        popopts = tripmage.compile_options(dict(seed='cache', margins=dict(top=1)))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = tripmage.RenderCache(tmpdir)
+            key = cache.key(img, popopts)
+            self.assertEqual(key, cache.key(img, tripmage.compile_options(dict(seed='cache', margins=dict(top=1), engine='scalar'))))
+            self.assertNotEqual(key, cache.key(img, tripmage.compile_options(dict(seed='other', margins=dict(top=1)))))
+            self.assertIsNone(cache.get(key))
+            expected = tripmage.cached_render(img, popopts, cache)
+            self.assertEqual(cache.get(key).tobytes(), expected.tobytes())
+            self.assertEqual(cache.get(key).size, expected.size)
+            # A hit doesn't render at all:
+            broken = dict(popopts)
+            broken['engine'] = 'no such engine'
+            self.assertEqual(tripmage.cached_render(img, tripmage.Pipeline(broken), cache).tobytes(), expected.tobytes())
+            # Lambdas can't be identified:
+            self.assertIsNone(cache.key(img, tripmage.compile_options(dict(distortion=dict(type='static_random', fn=lambda x, y, w, h, ctx: (0, 0))))))
+            # But any option value may contain '<':
+            self.assertIsNotNone(cache.key(img, tripmage.compile_options(dict(seed='a<b'))))
+
+    def test_render_cache_eviction(self):
+        rng = random.Random('test_render_cache_eviction')
+        img = tripmage.DecodedImage.from_image(make_random_image(rng, 10, 10))
+        entry_bytes = len(b'P6\n10 10\n255\n') + 300
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = tripmage.RenderCache(tmpdir, max_bytes=3 * entry_bytes)
+            keys = []
+            for i in range(5):
+                popopts = tripmage.compile_options(dict(seed='evict {}'.format(i)))
+                keys.append(cache.key(img, popopts))
+                tripmage.cached_render(img, popopts, cache)
+                # Make the order unambiguous, regardless of timestamp resolution:
+                os.utime(cache.path(keys[-1]), (i, i))
+                if i == 2:
+                    # Use the first one again, so it isn't the least recently used anymore:
+                    self.assertIsNotNone(cache.get(keys[0]))
+                    os.utime(cache.path(keys[0]), (2.5, 2.5))
+            self.assertLessEqual(sum(size for _, size, _ in cache.entries()), 3 * entry_bytes)
+            present = [cache.get(key) is not None for key in keys]
+            self.assertEqual(present, [True, False, False, True, True])
+
+            # Left behind by killed writers: Old ones are removed, new ones might still be written.
+            old_tmp = os.path.join(os.path.dirname(cache.path(keys[0])), 'old.tmp')
+            new_tmp = os.path.join(os.path.dirname(cache.path(keys[0])), 'new.tmp')
+            for path in [old_tmp, new_tmp]:
+                with open(path, 'wb') as fp:
+                    fp.write(bytes(entry_bytes))
+            os.utime(old_tmp, (0, 0))
+            cache.evict()
+            self.assertFalse(os.path.exists(old_tmp))
+            self.assertTrue(os.path.exists(new_tmp))
+            self.assertLessEqual(sum(size for _, size, _ in cache.entries()), 3 * entry_bytes)
+            self.assertEqual([cache.get(key) is not None for key in keys], [False, False, False, True, True])
+
+
+    @unittest.skipIf(tripmage.np is None, 'requires numpy')
+    def test_render_session(self):
+        rng = random.Random('test_render_session')
+        img = make_random_image(rng, 11, 7)
+        session = tripmage.RenderSession(img)
+        wobble = dict(type='static_random', fn=distortion_wobble)
+        steps = [
+            (dict(seed='session', margins=dict(left=1)), None),
+            (dict(seed='session', margins=dict(left=1), distortion_2=wobble),
+             ['sample 2', 'project 2', 'combine', 'convert']),
+            (dict(seed='session', margins=dict(left=1), distortion_2=wobble, components=dict(type='static_random', seed='c')),
+             ['components', 'project 1', 'project 2', 'project 3', 'combine', 'convert']),
+            (dict(seed='session', margins=dict(left=1), distortion_2=wobble, components=dict(type='static_random', seed='c')),
+             []),
+            (dict(seed='session', margins=dict(left=1), distortion_2=wobble, components=dict(type='static_random', seed='c'),
+                  colorspace=dict(type='projected_gammacorrected', col_to_rgb=tripmage.color_projgamma_col2rgb)),
+             ['convert']),
+            (dict(seed='session', margins=dict(left=1), distortion_2=wobble,
+                  components=dict(type='static_random', fn=components_alternating)), None),
+            (dict(seed='session', margins=dict(left=2), colorspace=dict(type='projected_gammacorrected', gamma=2.0)), None),
+        ]
+        for options, recomputed in steps:
+            with self.subTest(options=options):
+                actual = session.render(options)
+                expected = tripmage.render(img, tripmage.populate_options(options))
+                self.assertEqual(actual.tobytes(), expected.tobytes())
+                if recomputed is not None:
+                    self.assertEqual(session.recomputed, recomputed)
+
+
+    def test_preview_options(self):
+        full_size, size = (200, 100), (50, 25)
+        for scale_type, scale in [('abs', 8), ('rel', 0.1)]:
+            with self.subTest(scale_type=scale_type):
+                popopts = tripmage.populate_options(dict(
+                    seed='preview', margins=dict(left=8, top=4),
+                    distortion=dict(type='static_random', scale_type=scale_type, scale_x=scale, scale_y=scale)))
+                preview = tripmage.preview_options(popopts, full_size, size)
+                self.assertEqual(preview['margins'], dict(left=2, top=1, right=0, bottom=0))
+                for key in ['distortion_1', 'distortion_2', 'distortion_3']:
+                    full_x, full_y = tripmage.plug_call(popopts, key, 'fn', 0, 0, *full_size)
+                    preview_x, preview_y = tripmage.plug_call(preview, key, 'fn', 0, 0, *size)
+                    self.assertAlmostEqual(preview_x, full_x / 4)
+                    self.assertAlmostEqual(preview_y, full_y / 4)
+                self.assertEqual(
+                    [c.abc for c in tripmage.plug_call(preview, 'components', 'fn', 3, 2, *size)],
+                    [c.abc for c in tripmage.plug_call(popopts, 'components', 'fn', 12, 8, *full_size)])
+        popopts = tripmage.populate_options(dict(seed='preview', distortion_1=dict(type='static_random', fn=distortion_wobble)))
+        preview = tripmage.preview_options(popopts, full_size, size)
+        self.assertEqual(tripmage.plug_call(preview, 'distortion_1', 'fn', 3, 2, *size),
+                         tuple(v / 4 for v in distortion_wobble(12, 8, *full_size, None)))
+        if tripmage.np is not None:
+            dist_x, dist_y = tripmage.batch_call(preview, 'distortion_1', 'fn', tripmage.np.array([3]), tripmage.np.array([2]), *size)
+            self.assertEqual((dist_x[0], dist_y[0]), tripmage.plug_call(preview, 'distortion_1', 'fn', 3, 2, *size))
+            # Zero elements still have the structure of the results:
+            empty = tripmage.np.zeros((0,))
+            self.assertEqual([a.shape for a in tripmage.batch_call(popopts, 'distortion_1', 'fn', empty, empty, *full_size)],
+                             [(0,), (0,)])
+        # The preview's own types are internal, not something to ask for:
+        self.assertNotIn('scaled', tripmage.REGISTRY_DISTORTION)
+        self.assertNotIn('scaled', tripmage.REGISTRY_COMPONENTS)
+
+    def test_render_progressive(self):
+        rng = random.Random('test_render_progressive')
+        img = make_random_image(rng, 40, 30)
+        pyramid = tripmage.ImagePyramid(img, min_dim=8)
+        self.assertEqual([level.size for level in pyramid.levels], [(40, 30), (20, 15), (10, 8)])
+        engines = ['scalar'] if tripmage.np is None else ['scalar', 'numpy']
+        # Custom functions without a batch version, too:
+        for engine in engines:
+            for distortion in ['static_random', dict(type='static_random', fn=distortion_wobble)]:
+                with self.subTest(engine=engine, distortion=distortion):
+                    popopts = tripmage.populate_options(dict(seed='progressive', engine=engine, margins=dict(right=4),
+                                                             distortion_2=distortion))
+                    updates = list(tripmage.render_progressive(pyramid, popopts, max_dim=12, band_rows=7))
+                    row_begin, preview = updates[0]
+                    self.assertIsNone(row_begin)
+                    self.assertEqual(preview.size, (12 + 1, 9))
+                    self.assertEqual([row_begin for row_begin, _ in updates[1:]], [0, 7, 14, 21, 28])
+                    data = b''.join(band.tobytes() for _, band in updates[1:])
+                    self.assertEqual(data, tripmage.render(img, popopts).tobytes())
+
+    def test_render_streaming(self):
+        img = make_random_image(random.Random('test_render_streaming'), 23, 41)
+        decoded = tripmage.DecodedImage.from_image(img)
+        engines = ['scalar'] if tripmage.np is None else ['scalar', 'numpy']
+        for engine in engines:
+            for distortion in ['static_random', dict(type='static_random', scale_type='abs', scale_x=3, scale_y=4.5),
+                               dict(type='static_random', fn=distortion_wobble, max_offset=[2, 1])]:
+                options = dict(seed='streaming', engine=engine, distortion_2=distortion, margins=dict(top=3, bottom=2))
+                with self.subTest(engine=engine, distortion=distortion):
+                    popopts = tripmage.populate_options(options)
+                    stream_out = io.BytesIO()
+                    peak_rows = tripmage.render_streaming(io.BytesIO(decoded.data), decoded.size, popopts,
+                                                          stream_out, band_rows=5)
+                    stream_out.seek(0)
+                    self.assertEqual(tripmage.read_ppm(stream_out).tobytes(), tripmage.render(img, popopts).tobytes())
+                    self.assertLess(peak_rows, decoded.size[1])
+
+    def test_render_streaming_unbounded(self):
+        popopts = tripmage.populate_options(dict(distortion_1=dict(type='static_random', fn=distortion_wobble)))
+        with self.assertRaises(ValueError):
+            tripmage.render_streaming(io.BytesIO(bytes(3 * 4 * 4)), (4, 4), popopts, io.BytesIO())
+
+    def test_read_ppm_header(self):
+        stream = io.BytesIO(b'P6 # comment\n3\t2\n# another\n255\n' + bytes(range(18)))
+        self.assertEqual(tripmage.read_ppm_header(stream), (3, 2))
+        self.assertEqual(stream.read(), bytes(range(18)))
+
+    def test_profile(self):
+        img = make_random_image(random.Random('test_profile'), 11, 9)
+        options = dict(seed='profile', engine='scalar', distortion_1=dict(type='static_random', fn=distortion_wobble),
+                       interpolation=dict(type='nearest_neighbor', fn=interpolate_average))
+        expected = tripmage.render(img, tripmage.compile_options(options)).tobytes()
+        original = tripmage.read_rgb
+        with tripmage.Profile() as profile:
+            result = tripmage.render(img, tripmage.compile_options(options))
+        self.assertIs(tripmage.read_rgb, original)
+        self.assertEqual(result.tobytes(), expected)
+        report = json.loads(profile.to_json())
+        self.assertEqual(report['distortion_1:static_random.fn']['calls'], 11 * 9)
+        self.assertEqual(report['colorspace:projected_gammacorrected.col_to_rgb']['pixels'], 11 * 9)
+        self.assertEqual(report['read_rgb']['calls'], 4 * 3 * 11 * 9)
+        self.assertGreater(report['compute_rgb_bound']['seconds'], 0)
+        if tripmage.np is not None:
+            # The fast path for the default options, too:
+            with tripmage.Profile() as profile:
+                tripmage.render(img, tripmage.compile_options(dict(seed='profile', engine='numpy')))
+            report = profile.report()
+            self.assertEqual(report['constant_offsets']['pixels'], 11 * 9)
+            self.assertIn('distortion_1:static_random.fn_batch', report)
+            self.assertIn('components:static_random.fn_batch', report)
+
+    def test_bench(self):
+        names = [case['name'] for case in bench.bench_cases(quick=True)]
+        self.assertIn('mode=P', names)
+        self.assertIn('distortion=static_random', names)
+        case = bench.make_case('tiny', size=(8, 6), margins=2)
+        result = bench.run_case(case, repeats=1)
+        self.assertEqual(result['pixels_per_second'], 12 * 10 / result['seconds']['render'])
+        results = dict(cases=dict(tiny=result))
+        self.assertEqual(bench.compare(results, results), [])
+        slower = json.loads(json.dumps(results))
+        slower['cases']['tiny']['seconds']['render'] += 1.0
+        regressions = bench.compare(results, slower)
+        self.assertEqual([(name, what) for name, what, _, _ in regressions], [('tiny', 'render seconds')])
+
+    def test_render_batch(self):
+        rng = random.Random('test_render_batch')
+        with tempfile.TemporaryDirectory() as tmp:
+            dir_in = os.path.join(tmp, 'in')
+            dir_out = os.path.join(tmp, 'out')
+            os.mkdir(dir_in)
+            imgs = dict(a=make_random_image(rng, 7, 5), b=make_random_image(rng, 4, 9, 'L'))
+            for name, img in imgs.items():
+                img.save(os.path.join(dir_in, name + '.png'))
+            with open(os.path.join(dir_in, 'broken.png'), 'wb') as fp:
+                fp.write(b'not an image')
+            options = dict(seed='batch')
+            summary = tripmage.render_batch(tripmage.batch_items(dir_in, dir_out, options), jobs=2)
+            self.assertEqual((summary['files'], summary['succeeded'], summary['pixels']), (3, 2, 7 * 5 + 4 * 9))
+            self.assertEqual([failure['input'] for failure in summary['failed']], [os.path.join(dir_in, 'broken.png')])
+            for name, img in imgs.items():
+                expected = tripmage.render(img, tripmage.compile_options(options)).tobytes()
+                self.assertEqual(PIL.Image.open(os.path.join(dir_out, name + '.png')).tobytes(), expected)
+
+            # With one job, rendering happens in this process, so it can be profiled (like `--profile --batch`):
+            with tripmage.Profile() as profile:
+                summary = tripmage.render_batch(tripmage.batch_items(dir_in, os.path.join(tmp, 'profiled'), options),
+                                                jobs=1, io_threads=1)
+            self.assertEqual(summary['succeeded'], 2)
+            report = profile.report()
+            self.assertEqual(report['decode']['calls'], 2)
+            self.assertTrue(any(name.startswith('distortion_1:') for name in report), report)
+
+            manifest = os.path.join(tmp, 'manifest.jsonl')
+            with open(manifest, 'w') as fp:
+                fp.write(json.dumps(dict(input=os.path.join(dir_in, 'a.png'), output='c.ppm', options=dict(seed='c'))) + '\n')
+                fp.write(json.dumps(dict(input=os.path.join(dir_in, 'a.png'))) + '\n')
+                fp.write('not json\n')
+                fp.write(json.dumps(dict(output='d.png')) + '\n')
+            summary = tripmage.render_batch(tripmage.batch_items(manifest, dir_out, options))
+            self.assertEqual((summary['files'], summary['succeeded']), (4, 1))
+            self.assertIn('FileExistsError', summary['failed'][0]['error'])
+            # Malformed lines fail on their own:
+            self.assertEqual([failure['input'] for failure in summary['failed'][1:]],
+                             [manifest + ':3', manifest + ':4'])
+            self.assertIn('JSONDecodeError', summary['failed'][1]['error'])
+            self.assertIn('KeyError', summary['failed'][2]['error'])
+            expected = tripmage.render(imgs['a'], tripmage.compile_options(dict(seed='c'))).tobytes()
+            self.assertEqual(PIL.Image.open(os.path.join(dir_out, 'c.ppm')).tobytes(), expected)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,37 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
+import bisect
+import collections.abc
+import concurrent.futures
+import functools
+import hashlib
+import http.server
+import importlib
+import io
+import itertools
 import json
 import math
+import multiprocessing.shared_memory
 import os.path
+import PIL.GifImagePlugin
 import PIL.Image
+import queue
 import random
+import signal
+import socketserver
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional.  Without it, only the scalar engine is available.
+    np = None
 
 OPTIONS_DEFAULT = {
     'seed': str(random.getrandbits(32)),
@@ -23,36 +48,62 @@ OPTIONS_DEFAULT = {
     # I know, a list to store the distortions would me more intuitive.
     # However, this way the defaulting is slightly easier.
     'distortion': 'static_random',
+    # One of 'auto', 'scalar', 'numpy'.  See `run_options`.
+    'engine': 'auto',
 }
 
+# Each function below may additionally come in a "batch" version, registered under the same
+# name plus '_batch' (e.g. 'fn_batch').  It takes the same arguments, except that each number
+# is replaced by a NumPy array (or anything broadcastable to one), and each color by a tuple of
+# three such arrays.  It returns the same things, also with arrays in place of numbers.
+# The batch version is called on whole rows at once, and is preferred by `run_options` if it exists.
+# Otherwise the plain version is called for each element.
 REGISTRY_BORDER = dict()
 # Registrees must define:
 # * 'type': str, for easier debugging
 # * 'fn': function (x: float, y: float, w: int, h: int, ctx) -> (x: float, y: float), for the actual mapping
+# Registrees may define:
+# * 'fn_batch': batch version of 'fn'
 REGISTRY_INTERPOLATION = dict()
 # Registrees must define:
 # * 'type': str, for easier debugging
 # * 'fn': function (col_ul, col_ur, col_bl, col_br, x_frac: float, y_frac: float, ctx) -> col, for the actual mapping
 #   (where `col` is a `Color` instance, and `x_frac` and `y_frac` are < 1.)
+# Registrees may define:
+# * 'fn_batch': batch version of 'fn'
 REGISTRY_COLORSPACE = dict()
 # Registrees must define:
 # * 'type': str, for easier debugging
 # * 'rgb_to_col': function (r: int, g: int, b: int, ctx) -> col, for the "forwards" mapping
 # * 'col_to_rgb': function (col) -> (r: int, g: int, b: int, ctx), for the "backwards" mapping
+# Registrees may define:
+# * 'rgb_to_col_batch': batch version of 'rgb_to_col'
+# * 'col_to_rgb_batch': batch version of 'col_to_rgb'
 REGISTRY_COMPONENTS = dict()
 # Registrees must define:
 # * 'type': str, for easier debugging
 # * 'fn': function (x: int, y: int, w: int, h: int, ctx) -> (col, col, col), for the actual mapping
 #   the returned colors must be unit-length and orthogonal.
+# Registrees may define:
+# * 'fn_batch': batch version of 'fn'
 REGISTRY_DISTORTION = dict()
 # Registrees must define:
 # * 'type': str, for easier debugging
 # * 'fn': function (x: int, y: int, w: int, h: int, ctx) -> (float, float), for the actual mapping
 #   Must return *relative* coordinates.  So the identity transform would be implememented by `return (0.0, 0.0)`
+# Registrees may define:
+# * 'fn_batch': batch version of 'fn'
+# * 'fn_bounds': function (w: int, h: int, ctx) -> (float, float), the largest absolute x and y that 'fn'
+#   ever returns for an image of that size.  Needed for `render_streaming`, unless the user gives 'max_offset'.
+# Functions with a suffix (like 'fn_batch' or 'fn_bounds') belong to the function without it, see `populate_options`.
+FUNCTION_SUFFIXES = ('_batch', '_bounds')
 
 
 # Basically a `Vector3D`.
 class Color:
+    # There are a lot of these, so no per-instance dict.
+    __slots__ = ('abc',)
+
     def __init__(self, abc):
         assert len(abc) == 3
         self.abc = abc
@@ -74,7 +125,8 @@ class Color:
         return Color(list(self.abc))  # Just to make sure
 
     def vec_length(self):
-        return math.sqrt(sum(x ** 2 for x in self.abc))
+        a, b, c = self.abc
+        return math.sqrt(a * a + b * b + c * c)
 
     def clip_length(self, max_length):
         actual_length = self.vec_length()
@@ -87,13 +139,19 @@ class Color:
         return Color([x * factor for x in self.abc])
 
     def __add__(self, rhs):
-        return Color([(x + y) for x, y in zip(self.abc, rhs.abc)])
+        a1, b1, c1 = self.abc
+        a2, b2, c2 = rhs.abc
+        return Color([a1 + a2, b1 + b2, c1 + c2])
 
     def pointwise_prod(self, rhs):
-        return Color([(x * y) for x, y in zip(self.abc, rhs.abc)])
+        a1, b1, c1 = self.abc
+        a2, b2, c2 = rhs.abc
+        return Color([a1 * a2, b1 * b2, c1 * c2])
 
     def scalar_prod(self, rhs):
-        return sum(self.pointwise_prod(rhs).abc)
+        a1, b1, c1 = self.abc
+        a2, b2, c2 = rhs.abc
+        return a1 * a2 + b1 * b2 + c1 * c2
 
     def cross_prod(self, rhs):
         a1, b1, c1 = self.abc
@@ -104,6 +162,81 @@ class Color:
         return '<Color {} at 0x{:016x}>'.format(self.abc, id(self))
 
 
+# Many `Color`s at once, as a struct of arrays: `abc[0]` holds the first coordinate of every color.
+# `abc` has shape (3, ...), or anything that broadcasts to it.  Same operations as `Color`, in the
+# same order, so the results are identical to doing it one `Color` at a time.  Requires NumPy.
+class ColorArray:
+    __slots__ = ('abc',)
+
+    def __init__(self, abc):
+        if isinstance(abc, (tuple, list)):
+            abc = np.stack(np.broadcast_arrays(*abc))
+        assert len(abc) == 3, abc.shape
+        self.abc = abc
+
+    @staticmethod
+    def zeros(shape):
+        return ColorArray(np.zeros((3,) + tuple(shape)))
+
+    @staticmethod
+    def broadcast(col, shape):
+        # A single color (a `Color`, or three plain numbers), or a tuple of arrays, as a `ColorArray`
+        # that broadcasts to `shape`.  Doesn't copy single colors.
+        if isinstance(col, Color):
+            col = col.abc
+        if all(np.ndim(c) == 0 for c in col):
+            return ColorArray(np.array(col, dtype=float).reshape((3,) + (1,) * len(shape)))
+        return ColorArray(tuple(np.broadcast_to(c, shape) for c in col))
+
+    def __getitem__(self, index):
+        # E.g. `colors[row_begin:row_end]` for a band of rows.
+        index = index if isinstance(index, tuple) else (index,)
+        return ColorArray(self.abc[(slice(None),) + index])
+
+    def __setitem__(self, index, value):
+        index = index if isinstance(index, tuple) else (index,)
+        self.abc[(slice(None),) + index] = value.abc
+
+    def to_tuple(self):
+        # As a color in the batch convention, see the registries.
+        return tuple(self.abc)
+
+    def copy(self):
+        return ColorArray(self.abc.copy())
+
+    def vec_length(self):
+        a, b, c = self.abc
+        return np.sqrt(a * a + b * b + c * c)
+
+    def clip_length(self, max_length):
+        actual_length = self.vec_length()
+        with np.errstate(divide='ignore'):
+            factor = np.where(actual_length > max_length, max_length / actual_length, 1.0)
+        return self.scale(factor)
+
+    def scale(self, factor):
+        return ColorArray(self.abc * factor)
+
+    def __add__(self, rhs):
+        return ColorArray(self.abc + rhs.abc)
+
+    def pointwise_prod(self, rhs):
+        return ColorArray(self.abc * rhs.abc)
+
+    def scalar_prod(self, rhs):
+        a1, b1, c1 = self.abc
+        a2, b2, c2 = rhs.abc
+        return a1 * a2 + b1 * b2 + c1 * c2
+
+    def cross_prod(self, rhs):
+        a1, b1, c1 = self.abc
+        a2, b2, c2 = rhs.abc
+        return ColorArray(np.stack(np.broadcast_arrays(b1 * c2 - c1 * b2, c1 * a2 - a1 * c2, a1 * b2 - b1 * a2)))
+
+    def __repr__(self):
+        return '<ColorArray of shape {} at 0x{:016x}>'.format(self.abc.shape[1:], id(self))
+
+
 
 def _register(registry, key, **kwargs):
     kwargs['type'] = key
@@ -116,7 +249,54 @@ def border_snap(x, y, w, h, ctx):
     return (x, y)
 
 
-_register(REGISTRY_BORDER, 'snap', fn=border_snap)
+def border_snap_batch(x, y, w, h, ctx):
+    return (np.clip(x, 0, w - 1), np.clip(y, 0, h - 1))
+
+
+_register(REGISTRY_BORDER, 'snap', fn=border_snap, fn_batch=border_snap_batch)
+
+
+def border_wrap(x, y, w, h, ctx):
+    # Tiles the image.  Note that `%` rounds e.g. `-1e-20 % 10` up to exactly 10.
+    x, y = x % w, y % h
+    return (x if x < w else 0.0, y if y < h else 0.0)
+
+
+def border_wrap_batch(x, y, w, h, ctx):
+    x, y = np.mod(x, w), np.mod(y, h)
+    return (np.where(x < w, x, 0.0), np.where(y < h, y, 0.0))
+
+
+_register(REGISTRY_BORDER, 'wrap', fn=border_wrap, fn_batch=border_wrap_batch)
+
+
+def mirror_coordinate(v, size):
+    # Reflects at the centers of the outermost pixels, so that these don't appear twice.
+    if size == 1:
+        return 0
+    period = 2 * (size - 1)
+    v = v % period
+    if v >= period:
+        v = 0.0  # Rounding, see `border_wrap`
+    return v if v <= size - 1 else period - v
+
+
+def mirror_coordinate_batch(v, size):
+    period = np.maximum(2 * (size - 1), 1)
+    v = np.mod(v, period)
+    v = np.where(v < period, v, 0.0)
+    return np.where(size == 1, 0, np.where(v <= size - 1, v, period - v))
+
+
+def border_mirror(x, y, w, h, ctx):
+    return (mirror_coordinate(x, w), mirror_coordinate(y, h))
+
+
+def border_mirror_batch(x, y, w, h, ctx):
+    return (mirror_coordinate_batch(x, w), mirror_coordinate_batch(y, h))
+
+
+_register(REGISTRY_BORDER, 'mirror', fn=border_mirror, fn_batch=border_mirror_batch)
 
 
 def interpolate_nearest_neighbor(col_ul, col_ur, col_bl, col_br, x_frac, y_frac, ctx):
@@ -125,47 +305,152 @@ def interpolate_nearest_neighbor(col_ul, col_ur, col_bl, col_br, x_frac, y_frac,
     return [[col_ul, col_ur], [col_bl, col_br]][y_frac >= 0.5][x_frac >= 0.5]
 
 
-_register(REGISTRY_INTERPOLATION, 'nearest_neighbor', fn=interpolate_nearest_neighbor)
+def interpolate_nearest_neighbor_batch(col_ul, col_ur, col_bl, col_br, x_frac, y_frac, ctx):
+    right = x_frac >= 0.5
+    bottom = y_frac >= 0.5
+    return tuple(np.where(bottom, np.where(right, br, bl), np.where(right, ur, ul))
+                 for ul, ur, bl, br in zip(col_ul, col_ur, col_bl, col_br))
+
+
+_register(REGISTRY_INTERPOLATION, 'nearest_neighbor', fn=interpolate_nearest_neighbor,
+          fn_batch=interpolate_nearest_neighbor_batch)
+
+
+def bilinear_weights(x_frac, y_frac):
+    # The weights of the corners, in the order `compute_rgb` passes them: (x0, y0), (x0, y1), (x1, y0), (x1, y1).
+    # Works on numbers and arrays alike.
+    return ((1 - x_frac) * (1 - y_frac), (1 - x_frac) * y_frac, x_frac * (1 - y_frac), x_frac * y_frac)
+
+
+def interpolate_bilinear(col_ul, col_ur, col_bl, col_br, x_frac, y_frac, ctx):
+    w_ul, w_ur, w_bl, w_br = bilinear_weights(x_frac, y_frac)
+    return [math.floor(ul * w_ul + ur * w_ur + bl * w_bl + br * w_br + 0.5)
+            for ul, ur, bl, br in zip(col_ul, col_ur, col_bl, col_br)]
+
+
+def blend_bilinear_batch(cols, weights):
+    # The second half of `interpolate_bilinear_batch`, for weights that are already known, see `GatherMap`.
+    w_ul, w_ur, w_bl, w_br = weights
+    return tuple(np.floor(ul * w_ul + ur * w_ur + bl * w_bl + br * w_br + 0.5).astype(np.intp)
+                 for ul, ur, bl, br in zip(*cols))
+
+
+def interpolate_bilinear_batch(col_ul, col_ur, col_bl, col_br, x_frac, y_frac, ctx):
+    return blend_bilinear_batch((col_ul, col_ur, col_bl, col_br), bilinear_weights(x_frac, y_frac))
+
+
+_register(REGISTRY_INTERPOLATION, 'bilinear', fn=interpolate_bilinear, fn_batch=interpolate_bilinear_batch)
+
+
+# The gamma-correction is the expensive part of the conversions.  But there are only 256 possible
+# channel values, so both directions can be done by table instead, without changing the result.
+# The tables are built on first use, and kept for each `gamma` seen so far.
+
+@functools.lru_cache(maxsize=None)
+def gamma_table(gamma):
+    # Entry `c` is what `color_projgamma_rgb2col` does to the channel value `c` before projecting.
+    return tuple((c / 255) ** gamma * 2 - 1 for c in range(256))
+
+
+@functools.lru_cache(maxsize=None)
+def gamma_table_array(gamma):
+    table = np.array(gamma_table(gamma))
+    table.flags.writeable = False
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def inverse_gamma_thresholds(gamma):
+    # Entry `k` is the point in [0.0, 1.0] at which `color_projgamma_col2rgb` starts rounding up to `k + 1`.
+    return tuple(((k + 0.5) / 255) ** gamma for k in range(255))
+
+
+def unitcube_to_channel(c, gamma):
+    # Undo gamma-correction, scale up to [0, 255], round and clip.
+    thresholds = inverse_gamma_thresholds(gamma)
+    k = bisect.bisect_right(thresholds, c)
+    if (k > 0 and c - thresholds[k - 1] < 1e-12) or (k < 255 and thresholds[k] - c < 1e-12):
+        # Too close to call, so do it the long way:
+        k = min(max(0, round(min(max(0.0, c), 1.0) ** (1 / gamma) * 255)), 255)
+    return k
 
 
 def color_projgamma_rgb2col(r, g, b, ctx):
     # First, scale down to the intervals [0.0, 1.0] and apply gamma-correction.
     # Then, rescale to the intervals [-1.0, +1.0].
-    col = Color([(c / 255) ** ctx['gamma'] * 2 - 1 for c in [r, g, b]])
+    if type(r) is int and type(g) is int and type(b) is int:
+        table = gamma_table(ctx['gamma'])
+        c1, c2, c3 = table[r], table[g], table[b]
+    else:
+        c1, c2, c3 = [(c / 255) ** ctx['gamma'] * 2 - 1 for c in [r, g, b]]
     # Next, find something that lies on the outside.
-    max_component = max(abs(c) for c in col.abc)
+    max_component = max(abs(c1), abs(c2), abs(c3))
     # Finally, reshape the cube into a sphere, by rescaling along each line individually:
     if max_component < 1e-4:
         # Eh, close enough, won't matter anyway.
-        return col
+        return Color([c1, c2, c3])
     # Project `col` onto nearest cube face:
     #     col.scale(1 / max_component)
     # The length of that vector:
     #     col.vec_length() / max_component
     # Scaling *down* by that factor:
-    return col.scale(max_component / col.vec_length())
+    factor = max_component / math.sqrt(c1 ** 2 + c2 ** 2 + c3 ** 2)
+    return Color([c1 * factor, c2 * factor, c3 * factor])
 
 
 def color_projgamma_col2rgb(col, ctx):
-    # First,m undo the projection (see above):
-    max_component = max(abs(c) for c in col.abc)
+    # First, undo the projection (see above):
+    c1, c2, c3 = col.abc
+    max_component = max(abs(c1), abs(c2), abs(c3))
     if max_component >= 1e-4:
-        col = col.scale(col.vec_length() / max_component)
-    # Then go back to the intervals [0.0, 1.0], undo gamma-correction, and scale up to [0, 255].
-    unitcube_rgb = [c / 2 + 0.5 for c in col.abc]
+        factor = math.sqrt(c1 ** 2 + c2 ** 2 + c3 ** 2) / max_component
+        c1, c2, c3 = c1 * factor, c2 * factor, c3 * factor
+    # Then go back to the intervals [0.0, 1.0], and let the table do the rest.
+    unitcube_rgb = [c1 / 2 + 0.5, c2 / 2 + 0.5, c3 / 2 + 0.5]
     assert all(-1e-6 < c < 1 + 1e-6 for c in unitcube_rgb), (col, unitcube_rgb)
-    rgb = [min(max(0.0, c), 1.0) ** (1 / ctx['gamma']) * 255 for c in unitcube_rgb]
-    # Finally, round and clip:
-    try:
-        return [min(max(0, round(c)), 255) for c in rgb]
-    except BaseException as e:
-        print(col.abc, rgb, [type(c) for c in rgb])
-        raise e
+    gamma = ctx['gamma']
+    return [unitcube_to_channel(c, gamma) for c in unitcube_rgb]
+
+
+def color_projgamma_rgb2col_batch(r, g, b, ctx):
+    if all(np.issubdtype(np.asarray(c).dtype, np.integer) for c in [r, g, b]):
+        table = gamma_table_array(ctx['gamma'])
+        abc = [table[c] for c in [r, g, b]]
+    else:
+        abc = [(np.asarray(c) / 255) ** ctx['gamma'] * 2 - 1 for c in [r, g, b]]
+    # Same steps as in `color_projgamma_rgb2col`, in the same order, to get the same rounding.
+    max_component = np.maximum(np.maximum(np.abs(abc[0]), np.abs(abc[1])), np.abs(abc[2]))
+    length = np.sqrt(abc[0] * abc[0] + abc[1] * abc[1] + abc[2] * abc[2])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = np.where(max_component < 1e-4, 1.0, max_component / length)
+    return tuple(c * factor for c in abc)
+
+
+def color_projgamma_col2rgb_batch(col, ctx):
+    max_component = np.maximum(np.maximum(np.abs(col[0]), np.abs(col[1])), np.abs(col[2]))
+    length = np.sqrt(col[0] * col[0] + col[1] * col[1] + col[2] * col[2])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = np.where(max_component >= 1e-4, length / max_component, 1.0)
+    unitcube_rgb = [np.clip((c * factor) / 2 + 0.5, 0.0, 1.0) for c in col]
+    # Unlike in `color_projgamma_col2rgb`, NumPy's vectorized `**` is faster than a table here.
+    inv_gamma = 1 / ctx['gamma']
+    rgb = []
+    for c in unitcube_rgb:
+        c_rgb = c ** inv_gamma * 255
+        # NumPy's `**` may be off by an ulp compared to Python's.  This only matters
+        # if it changes the rounding, so redo the borderline cases exactly:
+        borderline = np.abs(c_rgb - np.floor(c_rgb) - 0.5) < 1e-6
+        if borderline.any():
+            c_rgb[borderline] = [x ** inv_gamma * 255 for x in c[borderline].tolist()]
+        rgb.append(np.clip(np.rint(c_rgb), 0, 255).astype(np.uint8))
+    return tuple(rgb)
 
 
 _register(REGISTRY_COLORSPACE, 'projected_gammacorrected', gamma=2.4,
           rgb_to_col=color_projgamma_rgb2col,
-          col_to_rgb=color_projgamma_col2rgb)
+          col_to_rgb=color_projgamma_col2rgb,
+          rgb_to_col_batch=color_projgamma_rgb2col_batch,
+          col_to_rgb_batch=color_projgamma_col2rgb_batch)
 
 
 def components_staticrandom(x, y, w, h, ctx):
@@ -201,12 +486,20 @@ def components_staticrandom(x, y, w, h, ctx):
     # ```
 
 
-_register(REGISTRY_COMPONENTS, 'static_random', fn=components_staticrandom)
+def components_staticrandom_batch(x, y, w, h, ctx):
+    # Constant everywhere, so plain numbers broadcast just fine.
+    return tuple(tuple(c.abc) for c in components_staticrandom(None, None, w, h, ctx))
+
+
+_register(REGISTRY_COMPONENTS, 'static_random', fn=components_staticrandom,
+          fn_batch=components_staticrandom_batch)
 
 
 def distortion_staticrandom(x, y, w, h, ctx):
-    ['ignore', x, y, w, h]
-    if '_cache' not in ctx:
+    ['ignore', x, y]
+    # Relative offsets depend on the size, and the same options may be used for images of any size:
+    cache = ctx.setdefault('_cache', dict())
+    if (w, h) not in cache:
         rng = random.Random('distortion_staticrandom|' + ctx['seed'])
         if ctx['scale_type'] == 'rel':
             magn_x = w * ctx['scale_x']
@@ -218,14 +511,67 @@ def distortion_staticrandom(x, y, w, h, ctx):
             raise ValueError('Unknown scale_type', ctx['scale_type'])
         x_offset = rng.uniform(-magn_x, magn_x)
         y_offset = rng.uniform(-magn_y, magn_y)
-        ctx['_cache'] = [x_offset, y_offset]
-    return list(ctx['_cache'])  # Copy
+        cache[(w, h)] = [x_offset, y_offset]
+    return list(cache[(w, h)])  # Copy
+
+
+def distortion_staticrandom_batch(x, y, w, h, ctx):
+    return tuple(distortion_staticrandom(None, None, w, h, ctx))
+
+
+def distortion_staticrandom_bounds(w, h, ctx):
+    if ctx['scale_type'] == 'rel':
+        return (abs(w * ctx['scale_x']), abs(h * ctx['scale_y']))
+    elif ctx['scale_type'] == 'abs':
+        return (abs(ctx['scale_x']), abs(ctx['scale_y']))
+    else:
+        raise ValueError('Unknown scale_type', ctx['scale_type'])
 
 
 _register(REGISTRY_DISTORTION, 'static_random', fn=distortion_staticrandom,
+          fn_batch=distortion_staticrandom_batch, fn_bounds=distortion_staticrandom_bounds,
           scale_type='rel', scale_x=0.05, scale_y=0.05)
 
 
+# For previews, see `preview_options`: The distortion 'inner' (populated, like 'distortion_1') of an image
+# of size 'inner_size', for an image that is scaled by 'factor' (a pair, for x and y).  Not registered,
+# because the context only makes sense as filled in by `preview_options`.
+def distortion_scaled(x, y, w, h, ctx):
+    factor_x, factor_y = ctx['factor']
+    dist_x, dist_y = plug_call(ctx, 'inner', 'fn', x / factor_x, y / factor_y, *ctx['inner_size'])
+    return (dist_x * factor_x, dist_y * factor_y)
+
+
+def distortion_scaled_batch(x, y, w, h, ctx):
+    factor_x, factor_y = ctx['factor']
+    dist_x, dist_y = batch_call(ctx, 'inner', 'fn', x / factor_x, y / factor_y, *ctx['inner_size'])
+    return (dist_x * factor_x, dist_y * factor_y)
+
+
+def distortion_scaled_bounds(w, h, ctx):
+    factor_x, factor_y = ctx['factor']
+    max_x, max_y = distortion_bounds(ctx, 'inner', *ctx['inner_size'])
+    return (max_x * abs(factor_x), max_y * abs(factor_y))
+
+
+PREVIEW_DISTORTION = dict(type='scaled', fn=distortion_scaled, fn_batch=distortion_scaled_batch,
+                          fn_bounds=distortion_scaled_bounds)
+
+
+# Same, for the components 'inner':
+def components_scaled(x, y, w, h, ctx):
+    factor_x, factor_y = ctx['factor']
+    return plug_call(ctx, 'inner', 'fn', x / factor_x, y / factor_y, *ctx['inner_size'])
+
+
+def components_scaled_batch(x, y, w, h, ctx):
+    factor_x, factor_y = ctx['factor']
+    return batch_call(ctx, 'inner', 'fn', x / factor_x, y / factor_y, *ctx['inner_size'])
+
+
+PREVIEW_COMPONENTS = dict(type='scaled', fn=components_scaled, fn_batch=components_scaled_batch)
+
+
 def plug_call(options, entry, fn, *args, **kwargs):
     # It is *probably* possible to default `fn` to `'fn'`, but I really don't
     # want to fuck around too much with syntax-quirks like that.
@@ -234,26 +580,128 @@ def plug_call(options, entry, fn, *args, **kwargs):
     return ctx[fn](*args, **kwargs, ctx=ctx)
 
 
+def bind_stage(options, entry, fn):
+    # Like `functools.partial(plug_call, options, entry, fn)`, but without the indirection.
+    ctx = options[entry]
+    return functools.partial(ctx[fn], ctx=ctx)
+
+
+# How many colorspace planes a `DecodedImage` keeps, and up to which size `run_options_numpy` (and
+# `render_band_scalar`) makes one.  A plane takes 24 bytes per pixel.
+COLORSPACE_PLANES_KEPT = 4
+COLORSPACE_PLANE_MAX_PIXELS = 1 << 24
+
+
+class DecodedImage:
+    # An image as 8-bit RGB, with all pixels in a single flat buffer:
+    # Pixel (x, y) is at `data[3 * (y * w + x):][:3]`.
+    # Used for the input (converted once), and for the output (written in-place).
+    # When streaming, the buffer only holds the window of `rows` (begin, end), starting with row `begin`.
+    def __init__(self, size, data, rows=None):
+        w, h = size
+        if not isinstance(data, (bytes, bytearray)):
+            # E.g. a NumPy array, which can be used without copying:
+            data = memoryview(data).cast('B')
+        rows = (0, h) if rows is None else tuple(rows)
+        assert 0 <= rows[0] <= rows[1] <= h, (size, rows)
+        assert len(data) == 3 * w * (rows[1] - rows[0]), (size, rows, len(data))
+        self.size = (w, h)
+        self.data = data
+        self.rows = rows
+        # See `keep_colorspace_plane`:
+        self.colorspace_planes = dict()
+
+    @staticmethod
+    def from_image(img):
+        if isinstance(img, DecodedImage):
+            return img
+        if img.mode in ['I', 'I;16', 'I;16B', 'I;16L', 'I;16N']:
+            # PIL would just clip these to 255, so scale them down instead:
+            img = img.convert('I').point(lambda v: v * (1 / 256)).convert('L')
+        if img.mode != 'RGB':
+            # Takes care of palettes, grayscale, and dropping alpha:
+            img = img.convert('RGB')
+        return DecodedImage(img.size, img.tobytes())
+
+    def array(self):
+        # A view of shape (h, w, 3), without copying.  Only the `rows` that are there.
+        w = self.size[0]
+        return np.frombuffer(self.data, dtype=np.uint8).reshape(self.rows[1] - self.rows[0], w, 3)
+
+    def keep_colorspace_plane(self, popopts):
+        # Converts the whole image to `popopts`' colorspace, and keeps the result for later
+        # renders with the same colorspace, e.g. in animations or when only the seed changes.
+        # Only the `COLORSPACE_PLANES_KEPT` most recently kept planes stay.
+        key = colorspace_key(popopts['colorspace'])
+        if key not in self.colorspace_planes:
+            self.colorspace_planes[key] = ColorArray(self.colorspace_rows(popopts, 0, self.size[1]))
+            while len(self.colorspace_planes) > COLORSPACE_PLANES_KEPT:
+                del self.colorspace_planes[next(iter(self.colorspace_planes))]
+
+    def colorspace_rows(self, popopts, row_begin, row_end):
+        # The rows `row_begin` to `row_end`, converted to `popopts`' colorspace.
+        # Returns a color, i.e. a tuple of three arrays of shape (row_end - row_begin, w).
+        plane = self.colorspace_planes.get(colorspace_key(popopts['colorspace']))
+        if plane is not None:
+            return plane[row_begin:row_end].to_tuple()
+        assert self.rows[0] <= row_begin and row_end <= self.rows[1], (self.rows, row_begin, row_end)
+        rgb = self.array()[row_begin - self.rows[0]:row_end - self.rows[0]]
+        return batch_call(popopts, 'colorspace', 'rgb_to_col', rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2])
+
+    def tobytes(self):
+        return bytes(self.data)
+
+    def to_image(self):
+        return PIL.Image.frombuffer('RGB', self.size, self.data, 'raw', 'RGB', 0, 1)
+
+    def to_ppm(self, stream):
+        # Binary PPM is just a tiny header, followed by exactly our buffer.
+        stream.write('P6\n{} {}\n255\n'.format(*self.size).encode())
+        stream.write(self.data)
+
+
+def colorspace_key(ctx):
+    # Identifies what the colorspace `ctx` does.  Note that colorspaces must not depend on 'seed'.
+    params = {k: v for k, v in ctx.items() if not callable(v) and not k.startswith('_') and k != 'seed'}
+    return (ctx['rgb_to_col'], ctx.get('rgb_to_col_batch'), json.dumps(params, sort_keys=True, default=repr))
+
+
 def read_rgb(img, x, y):
-    raw = img.getpixel((x, y))
-    if len(raw) == 1:
-        return raw * 3
-    elif len(raw) == 3:
-        return raw
-    elif len(raw) == 4:
-        return raw[:3]
-    else:
-        raise AssertionError('What kind of channelset is this?!', raw, img.mode, (x, y))
+    # `img` must be a `DecodedImage`.
+    data = img.data
+    index = 3 * ((y - img.rows[0]) * img.size[0] + x)
+    return (data[index], data[index + 1], data[index + 2])
+
+
+def wraps_around(popopts):
+    # With `border_wrap`, the image tiles, so the neighbor after the last pixel is the first one.
+    # Otherwise, the last pixel is its own neighbor.
+    return popopts['border'].get('fn') is border_wrap
+
+
+def upper_neighbor(v, size, wrap):
+    # Along one axis, the pixel after (or at) `v`, which must be in [0, size).
+    return math.ceil(v) % size if wrap else min(size - 1, math.ceil(v))
+
+
+def upper_neighbor_batch(v, size, wrap):
+    return np.mod(np.ceil(v), size) if wrap else np.minimum(size - 1, np.ceil(v))
 
 
 def compute_rgb(img, x: float, y: float, popopts):
+    return compute_rgb_bound(img, x, y, functools.partial(plug_call, popopts, 'interpolation', 'fn'),
+                             wraps_around(popopts))
+
+
+def compute_rgb_bound(img, x: float, y: float, interpolation, wrap=False):
+    # Like `compute_rgb`, with the interpolation function already bound to its context.
     img_w, img_h = img.size
     assert 0 <= x < img_w
     assert 0 <= y < img_h
-    xs = [math.floor(x), min(img_w - 1, math.ceil(x))]
-    ys = [math.floor(y), min(img_h - 1, math.ceil(y))]
+    xs = [math.floor(x), upper_neighbor(x, img_w, wrap)]
+    ys = [math.floor(y), upper_neighbor(y, img_h, wrap)]
     cols = [read_rgb(img, x_int, y_int) for x_int in xs for y_int in ys]
-    return plug_call(popopts, 'interpolation', 'fn', *cols, x - xs[0], y - ys[0])
+    return interpolation(*cols, x - xs[0], y - ys[0])
 
 
 def project_col(raw_col, component):
@@ -262,51 +710,672 @@ def project_col(raw_col, component):
     return component.scale(raw_col.scalar_prod(component))
 
 
+def _stack_results(results, shape, template):
+    # Turns a list of per-element results into the structure a batch function would return.
+    # `template` is one result, which gives the structure even if there are no `results`.
+    if isinstance(template, Color):
+        return _stack_results([r.abc for r in results], shape, template.abc)
+    if isinstance(template, (tuple, list)):
+        return tuple(_stack_results([r[i] for r in results], shape, template[i]) for i in range(len(template)))
+    if not results:
+        return np.zeros(shape)
+    return np.array(results).reshape(shape)
+
+
+def _call_elementwise(fn, args, ctx, color_type):
+    # Emulates a batch function by calling the plain `fn` for each element.
+    shape = np.broadcast_shapes(*[np.shape(c) for arg in args for c in (arg if isinstance(arg, tuple) else [arg])])
+    columns = []
+    for arg in args:
+        if isinstance(arg, tuple):
+            channels = [np.broadcast_to(c, shape).ravel().tolist() for c in arg]
+            columns.append([color_type(abc) for abc in zip(*channels)])
+        else:
+            columns.append(np.broadcast_to(arg, shape).ravel().tolist())
+    results = [fn(*element_args, ctx=ctx) for element_args in zip(*columns)]
+    if not results:
+        # Zero elements (e.g. from `constant_batch_result`), but the structure is still needed:
+        zeros = [color_type((0, 0, 0)) if isinstance(arg, tuple) else 0 for arg in args]
+        return _stack_results([], shape, fn(*zeros, ctx=ctx))
+    return _stack_results(results, shape, results[0])
+
+
+def batch_call(options, entry, fn, *args):
+    # Like `plug_call`, but all numbers are arrays, and colors are tuples of arrays.
+    ctx = options[entry]
+    assert isinstance(ctx, dict), (options, 'THE PROBLEM IS WITH KEY', entry, ctx)
+    if fn + '_batch' in ctx:
+        return ctx[fn + '_batch'](*args, ctx=ctx)
+    # `col_to_rgb` expects a `Color`, interpolation expects plain (r, g, b) values:
+    color_type = Color if fn == 'col_to_rgb' else tuple
+    return _call_elementwise(ctx[fn], args, ctx, color_type)
+
+
+# Number of output pixels `run_options_numpy` handles per batch call.  Bounds memory usage.
+BATCH_PIXELS = 1 << 16
+
+
+def render_rows_numpy(img, popopts, dst_y_begin, dst_y_end):
+    # Renders the output rows `dst_y_begin` (inclusive) to `dst_y_end` (exclusive),
+    # in destination coordinates.  `img` is the input, a `DecodedImage`.
+    # Every floating-point operation happens in the same order as in `run_options_scalar`,
+    # so the result is identical.
+    source_cols = sample_rows_numpy(img, popopts, dst_y_begin, dst_y_end)
+
+    # Determine which components to use at this point:
+    component_vecs = components_rows_numpy(img.size, popopts, dst_y_begin, dst_y_end)
+
+    # Project onto the components we're actually interested in.  This is `project_col`:
+    prods = [project_prod_numpy(raw_col, component) for raw_col, component in zip(source_cols, component_vecs)]
+    return combine_numpy(prods, component_vecs, popopts)
+
+
+def dst_grid_numpy(img_w, popopts, dst_y_begin, dst_y_end):
+    # The destination coordinates (dst_y, dst_x) of the output rows `dst_y_begin` to `dst_y_end`.
+    margins = popopts['margins']
+    return np.mgrid[dst_y_begin:dst_y_end, -margins['left']:img_w + margins['right']]
+
+
+def sample_rows_numpy(img, popopts, dst_y_begin, dst_y_end, channels=(0, 1, 2)):
+    # For each of the `channels`, the colors it reads for the output rows `dst_y_begin` to `dst_y_end`.
+    img_w, img_h = img.size
+    pixels = img.array().reshape(-1, 3)
+    dst_y, dst_x = dst_grid_numpy(img_w, popopts, dst_y_begin, dst_y_end)
+    dist_keys = ['distortion_{}'.format(i + 1) for i in channels]
+    plane = None
+    if popopts['interpolation'].get('fn_batch') is interpolate_nearest_neighbor_batch:
+        plane = img.colorspace_planes.get(colorspace_key(popopts['colorspace']))
+
+    # Determine from where we should read the data:
+    dist_vecs = [batch_call(popopts, dist_key, 'fn', dst_x, dst_y, img_w, img_h) for dist_key in dist_keys]
+    source_locs = [batch_call(popopts, 'border', 'fn', dst_x - dist_x, dst_y - dist_y, img_w, img_h) for dist_x, dist_y in dist_vecs]
+
+    # Make the data usable.  This is `compute_rgb`, and `rgb_to_col`:
+    wrap = wraps_around(popopts)
+    source_cols = []
+    for src_x, src_y in source_locs:
+        xs = [np.floor(src_x), upper_neighbor_batch(src_x, img_w, wrap)]
+        ys = [np.floor(src_y), upper_neighbor_batch(src_y, img_h, wrap)]
+        indices = [((y_int.astype(np.intp) - img.rows[0]) * img_w + x_int.astype(np.intp)) for x_int in xs for y_int in ys]
+        if plane is not None:
+            # Let the interpolation choose among the indices, and look up the already converted color:
+            index, = interpolate_nearest_neighbor_batch(*[(index,) for index in indices], src_x - xs[0], src_y - ys[0],
+                                                        ctx=popopts['interpolation'])
+            source_cols.append(tuple(plane.abc.reshape(3, -1).take(index, axis=1)))
+            continue
+        cols = [tuple(np.moveaxis(pixels.take(index, axis=0), -1, 0)) for index in indices]
+        rgb = batch_call(popopts, 'interpolation', 'fn', *cols, src_x - xs[0], src_y - ys[0])
+        source_cols.append(batch_call(popopts, 'colorspace', 'rgb_to_col', *rgb))
+    return source_cols
+
+
+def components_rows_numpy(img_size, popopts, dst_y_begin, dst_y_end):
+    # The components for the output rows `dst_y_begin` to `dst_y_end`.
+    img_w, img_h = img_size
+    dst_y, dst_x = dst_grid_numpy(img_w, popopts, dst_y_begin, dst_y_end)
+    return batch_call(popopts, 'components', 'fn', dst_x, dst_y, img_w, img_h)
+
+
+def project_prod_numpy(raw_col, component):
+    # The scalar product in `project_col`.
+    return raw_col[0] * component[0] + raw_col[1] * component[1] + raw_col[2] * component[2]
+
+
+def combine_numpy(prods, component_vecs, popopts):
+    # Scales the components by `prods`, combines, and converts back to RGB.
+    return convert_combined_numpy(sum_components_numpy(prods, component_vecs), popopts)
+
+
+def sum_components_numpy(prods, component_vecs):
+    # The components scaled by `prods`, added up, as a `ColorArray`.
+    shape = np.shape(prods[0])
+    component_cols = [ColorArray.broadcast(component, shape).scale(prod) for prod, component in zip(prods, component_vecs)]
+    return component_cols[0] + component_cols[1] + component_cols[2]
+
+
+def convert_combined_numpy(result_col, popopts):
+    # `clip_length(1)`, and back to RGB, as an array of shape (..., 3).
+    result_col = result_col.clip_length(1)
+
+    # Aaand done:
+    result_rgb = batch_call(popopts, 'colorspace', 'col_to_rgb', result_col.to_tuple())
+    return np.stack(np.broadcast_arrays(*result_rgb), axis=-1).astype(np.uint8)
+
+
+def constant_batch_result(popopts, entry, img_w, img_h):
+    # Returns what `entry`'s 'fn_batch' returns everywhere, if that doesn't depend on the
+    # coordinates (i.e. it returns plain numbers instead of arrays).  Otherwise returns None.
+    ctx = popopts[entry]
+    if 'fn_batch' not in ctx:
+        return None
+    # Asking for zero pixels costs nothing, and reveals whether the result has a shape.
+    empty = np.zeros((0,), dtype=int)
+    result = batch_call(popopts, entry, 'fn', empty, empty, img_w, img_h)
+    if not _is_plain_numbers(result):
+        return None
+    return result
+
+
+def _is_plain_numbers(result):
+    if isinstance(result, (tuple, list)):
+        return all(_is_plain_numbers(r) for r in result)
+    return np.ndim(result) == 0
+
+
+def constant_offsets(popopts, img_w, img_h):
+    # Detects the case where each channel is just the whole image, shifted by a constant vector,
+    # and projected on a constant component.  Returns (dist_vecs, component_vecs) or None.
+    if popopts['border'].get('fn_batch') is not border_snap_batch:
+        return None
+    if popopts['interpolation'].get('fn_batch') is not interpolate_nearest_neighbor_batch:
+        return None
+    dist_vecs = [constant_batch_result(popopts, 'distortion_{}'.format(i), img_w, img_h) for i in range(1, 3 + 1)]
+    component_vecs = constant_batch_result(popopts, 'components', img_w, img_h)
+    if component_vecs is None or any(dist_vec is None for dist_vec in dist_vecs):
+        return None
+    return dist_vecs, component_vecs
+
+
+def snap_nearest_indices(dst, offset, size):
+    # What `border_snap` and `compute_rgb` do along a single axis, for a constant offset.
+    # Returns the lower and upper neighbor, and whether the fraction is at least one half.
+    src = np.clip(dst - offset, 0, size - 1)
+    lower = np.floor(src)
+    upper = np.minimum(size - 1, np.ceil(src))
+    return lower.astype(np.intp), upper.astype(np.intp), (src - lower) >= 0.5
+
+
+def render_constant_offsets_numpy(img, popopts, dist_vecs, component_vecs, row_begin, row_end, result):
+    # Fast path for `constant_offsets`: Convert and project the input once per channel,
+    # then each output band is just an edge-clamped, shifted copy of that.
+    # Renders the output rows `row_begin` to `row_end` (counting from the top margin) into `result`.
+    img_w, img_h = img.size
+    margins = popopts['margins']
+    dst_xs = np.arange(-margins['left'], img_w + margins['right'])
+    dst_ys = np.arange(row_begin - margins['top'], row_end - margins['top'])
+    if len(dst_ys) == 0:
+        return
+    channels = []
+    for dist_x, dist_y in dist_vecs:
+        # `interpolate_nearest_neighbor` picks the upper x if the *y* fraction is large, and
+        # vice versa.  So the rows and columns each fall into two classes, and within each
+        # combination of classes the lookup is separable.
+        x_lower, x_upper, x_frac_large = snap_nearest_indices(dst_xs, dist_x, img_w)
+        y_lower, y_upper, y_frac_large = snap_nearest_indices(dst_ys, dist_y, img_h)
+        channels.append(((x_lower, x_upper), (y_lower, y_upper), x_frac_large, y_frac_large))
+
+    # Only the input rows that are actually needed:
+    src_begin = min(y_choices[0].min() for _, y_choices, _, _ in channels)
+    src_end = max(y_choices[1].max() for _, y_choices, _, _ in channels) + 1
+    source_col = img.colorspace_rows(popopts, src_begin, src_end)
+    src_prods = [project_prod_numpy(source_col, component) for component in component_vecs]
+
+    band_rows = max(1, BATCH_PIXELS // len(dst_xs))
+    for band_begin in range(0, len(dst_ys), band_rows):
+        band_end = min(len(dst_ys), band_begin + band_rows)
+        prods = []
+        for src_prod, (x_choices, y_choices, x_frac_large, y_frac_large) in zip(src_prods, channels):
+            band = np.empty((band_end - band_begin, len(dst_xs)))
+            for y_large in [False, True]:
+                rows = np.flatnonzero(y_frac_large[band_begin:band_end] == y_large)
+                if len(rows) == 0:
+                    continue
+                for x_large in [False, True]:
+                    cols = np.flatnonzero(x_frac_large == x_large)
+                    if len(cols) == 0:
+                        continue
+                    src_rows = y_choices[x_large][band_begin:band_end][rows] - src_begin
+                    src_cols = x_choices[y_large][cols]
+                    band[np.ix_(rows, cols)] = src_prod.take(src_rows, axis=0).take(src_cols, axis=1)
+            prods.append(band)
+        result[band_begin:band_end] = combine_numpy(prods, component_vecs, popopts)
+
+
+def render_band_numpy(img, popopts, row_begin, row_end, result):
+    # Renders the output rows `row_begin` to `row_end` (counting from the top margin) into
+    # `result`, an array of shape (row_end - row_begin, dst_w, 3).
+    img_w, img_h = img.size
+    offsets = constant_offsets(popopts, img_w, img_h)
+    if offsets is not None:
+        render_constant_offsets_numpy(img, popopts, *offsets, row_begin, row_end, result)
+        return
+
+    top = popopts['margins']['top']
+    band_rows = max(1, BATCH_PIXELS // result.shape[1])
+    for band_begin in range(row_begin, row_end, band_rows):
+        band_end = min(row_end, band_begin + band_rows)
+        result[band_begin - row_begin:band_end - row_begin] = render_rows_numpy(
+            img, popopts, band_begin - top, band_end - top)
+
+
+def run_options_numpy(img, popopts):
+    # Does exactly what `run_options_scalar` does, but on many pixels at once.
+    img = DecodedImage.from_image(img)
+    img_w, img_h = img.size
+    # With nearest-neighbor, each sample is just some input pixel.  So convert each input pixel once, instead of
+    # once per channel and output pixel.  The plane stays with `img`, e.g. for the next render with another seed.
+    if popopts['interpolation'].get('fn_batch') is interpolate_nearest_neighbor_batch and \
+            img.rows == (0, img_h) and img_w * img_h <= COLORSPACE_PLANE_MAX_PIXELS:
+        img.keep_colorspace_plane(popopts)
+    dst_w, dst_h = output_size(img.size, popopts)
+    result = np.empty((dst_h, dst_w, 3), dtype=np.uint8)
+    render_band_numpy(img, popopts, 0, dst_h, result)
+    return DecodedImage((dst_w, dst_h), result)
+
+
+class GatherMap:
+    # Everything about a render that depends only on the options and the input size, but not on
+    # the pixel values: Where each channel reads from, and which components it projects onto.
+    # With this computed once, each frame of that size is just a gather, project, and combine.
+    def __init__(self, popopts, img_size):
+        self.popopts = popopts
+        self.img_size = img_size
+        img_w, img_h = img_size
+        dst_w, dst_h = output_size(img_size, popopts)
+        margins = popopts['margins']
+        dist_keys = ['distortion_{}'.format(i) for i in range(1, 3 + 1)]
+        index_type = np.int32 if img_w * img_h < 2 ** 31 else np.intp
+        # With nearest-neighbor, each channel reads just a single pixel:
+        self.nearest = popopts['interpolation'].get('fn_batch') is interpolate_nearest_neighbor_batch
+        self.indices = np.empty((3, 1 if self.nearest else 4, dst_h, dst_w), dtype=index_type)
+        self.fracs = None if self.nearest else np.empty((3, 2, dst_h, dst_w))
+        # With bilinear interpolation, the weights of the corners can be computed beforehand, too:
+        self.weights = None
+        if popopts['interpolation'].get('fn_batch') is interpolate_bilinear_batch:
+            self.fracs = None
+            self.weights = np.empty((3, 4, dst_h, dst_w))
+        # Either plain numbers, or an array of shape (3, 3, dst_h, dst_w):
+        self.component_vecs = constant_batch_result(popopts, 'components', img_w, img_h)
+        constant_components = self.component_vecs is not None
+        if not constant_components:
+            self.component_vecs = np.empty((3, 3, dst_h, dst_w))
+
+        wrap = wraps_around(popopts)
+        band_rows = max(1, BATCH_PIXELS // dst_w)
+        for band_begin in range(0, dst_h, band_rows):
+            rows = slice(band_begin, min(dst_h, band_begin + band_rows))
+            dst_y, dst_x = np.mgrid[rows.start - margins['top']:rows.stop - margins['top'],
+                                    -margins['left']:img_w + margins['right']]
+            # Same as in `render_rows_numpy`:
+            dist_vecs = [batch_call(popopts, dist_key, 'fn', dst_x, dst_y, img_w, img_h) for dist_key in dist_keys]
+            source_locs = [batch_call(popopts, 'border', 'fn', dst_x - dist_x, dst_y - dist_y, img_w, img_h) for dist_x, dist_y in dist_vecs]
+            for channel, (src_x, src_y) in enumerate(source_locs):
+                xs = [np.floor(src_x), upper_neighbor_batch(src_x, img_w, wrap)]
+                ys = [np.floor(src_y), upper_neighbor_batch(src_y, img_h, wrap)]
+                indices = [(y_int.astype(np.intp) * img_w + x_int.astype(np.intp)) for x_int in xs for y_int in ys]
+                fracs = (src_x - xs[0], src_y - ys[0])
+                if self.nearest:
+                    # Let the interpolation choose among the indices, instead of among the colors:
+                    chosen, = interpolate_nearest_neighbor_batch(*[(index,) for index in indices], *fracs,
+                                                                 ctx=popopts['interpolation'])
+                    self.indices[channel, 0, rows] = chosen
+                else:
+                    for corner, index in enumerate(indices):
+                        self.indices[channel, corner, rows] = index
+                    if self.weights is not None:
+                        for corner, weight in enumerate(bilinear_weights(*fracs)):
+                            self.weights[channel, corner, rows] = weight
+                    else:
+                        for axis, frac in enumerate(fracs):
+                            self.fracs[channel, axis, rows] = frac
+            if not constant_components:
+                component_vecs = batch_call(popopts, 'components', 'fn', dst_x, dst_y, img_w, img_h)
+                for channel, component in enumerate(component_vecs):
+                    for i, c in enumerate(component):
+                        self.component_vecs[channel, i, rows] = c
+
+    def render(self, img):
+        # Renders `img`, which must have the size this map was computed for.
+        img = DecodedImage.from_image(img)
+        assert img.size == self.img_size, (img.size, self.img_size)
+        popopts = self.popopts
+        img_w, img_h = img.size
+        dst_w, dst_h = output_size(img.size, popopts)
+        result = np.empty((dst_h, dst_w, 3), dtype=np.uint8)
+        constant_components = not isinstance(self.component_vecs, np.ndarray)
+        if self.nearest:
+            # Convert each input pixel only once, instead of once per output pixel and channel:
+            source_col = tuple(np.broadcast_to(c, (img_h, img_w)).ravel()
+                               for c in img.colorspace_rows(popopts, 0, img_h))
+            if constant_components:
+                src_prods = [project_prod_numpy(source_col, component) for component in self.component_vecs]
+        else:
+            pixels = img.array().reshape(-1, 3)
+
+        band_rows = max(1, BATCH_PIXELS // dst_w)
+        for band_begin in range(0, dst_h, band_rows):
+            rows = slice(band_begin, min(dst_h, band_begin + band_rows))
+            if constant_components:
+                component_vecs = self.component_vecs
+            else:
+                component_vecs = [tuple(c[rows] for c in component) for component in self.component_vecs]
+            prods = []
+            for channel, component in enumerate(component_vecs):
+                if self.nearest:
+                    index = self.indices[channel, 0, rows]
+                    if constant_components:
+                        prods.append(src_prods[channel].take(index))
+                        continue
+                    col = tuple(c.take(index) for c in source_col)
+                else:
+                    cols = [tuple(np.moveaxis(pixels.take(index, axis=0), -1, 0)) for index in self.indices[channel, :, rows]]
+                    if self.weights is not None:
+                        rgb = blend_bilinear_batch(cols, self.weights[channel, :, rows])
+                    else:
+                        rgb = batch_call(popopts, 'interpolation', 'fn', *cols, *self.fracs[channel, :, rows])
+                    col = batch_call(popopts, 'colorspace', 'rgb_to_col', *rgb)
+                prods.append(project_prod_numpy(col, component))
+            result[rows] = combine_numpy(prods, component_vecs, popopts)
+        return DecodedImage((dst_w, dst_h), result)
+
+
+def stage_key(popopts, entries, without=()):
+    # Identifies what the options `entries` of `popopts` are, leaving out the keys `without`.
+    # Functions are identified by name, and by identity in case the name is ambiguous (e.g. lambdas).
+    parts = []
+    for entry in entries:
+        value = popopts[entry]
+        if isinstance(value, dict):
+            value = {k: v for k, v in value.items() if k not in without and not k.startswith('_')}
+            parts.append([entry, _jsonable(value), sorted(id(v) for v in value.values() if callable(v))])
+        else:
+            parts.append([entry, _jsonable(value)])
+    return json.dumps(parts, sort_keys=True, default=repr)
+
+
+class RenderSession:
+    # Renders the same image again and again with slightly different options, e.g. while tuning
+    # them interactively.  Keeps the intermediate results of the last render, and recomputes only
+    # what depends on options that changed: Changing 'distortion_2' only resamples the second
+    # channel, changing the 'components' only projects again, and changing only 'col_to_rgb'
+    # only converts again.  Note that the colorspace parameters (e.g. 'gamma') are also used by
+    # 'rgb_to_col', so changing them starts over.  Requires NumPy.
+    def __init__(self, img):
+        self.img = DecodedImage.from_image(img)
+        self.popopts = None
+        # Each is a pair (key, value), see `_stage`:
+        self.samples = [None] * 3  # The colors each channel reads, as a `ColorArray`
+        self.components = None  # `component_vecs`, as plain numbers or `ColorArray`s
+        self.prods = [None] * 3  # Each channel's projection onto its component
+        self.combined = None  # The components scaled by the projections, added up, as a `ColorArray`
+        self.result = None  # The `DecodedImage`
+        # What the last call to `render` had to recompute, for the curious:
+        self.recomputed = []
+
+    def _stage(self, cached, key, name, compute):
+        if cached is not None and cached[0] == key:
+            return cached
+        self.recomputed.append(name)
+        return (key, compute())
+
+    def render(self, options):
+        # Returns a `DecodedImage`, just like `render` would.  `options` can be raw or populated
+        # options, or a `Pipeline`.
+        if not isinstance(options, Pipeline):
+            options = compile_options(options)
+        # Keep the functions alive, so that their ids in the keys stay unique:
+        self.popopts = options
+        self.recomputed = []
+        dst_w, dst_h = output_size(self.img.size, options)
+        band_rows = max(1, BATCH_PIXELS // dst_w)
+        forward = dict(without=('col_to_rgb', 'col_to_rgb_batch'))
+        common = [stage_key(options, ['margins', 'border', 'interpolation']),
+                  stage_key(options, ['colorspace'], **forward)]
+
+        def sample(channel):
+            samples = ColorArray.zeros((dst_h, dst_w))
+            for band_begin in range(0, dst_h, band_rows):
+                band_end = min(dst_h, band_begin + band_rows)
+                top = options['margins']['top']
+                col, = sample_rows_numpy(self.img, options, band_begin - top, band_end - top, channels=[channel])
+                samples[band_begin:band_end] = ColorArray.broadcast(col, (band_end - band_begin, dst_w))
+            return samples
+
+        for channel in range(3):
+            key = common + [stage_key(options, ['distortion_{}'.format(channel + 1)])]
+            self.samples[channel] = self._stage(self.samples[channel], key, 'sample {}'.format(channel + 1),
+                                                functools.partial(sample, channel))
+
+        def components():
+            img_w, img_h = self.img.size
+            constant = constant_batch_result(options, 'components', img_w, img_h)
+            if constant is not None:
+                return constant
+            component_vecs = components_rows_numpy(self.img.size, options, -options['margins']['top'],
+                                                   dst_h - options['margins']['top'])
+            return [ColorArray.broadcast(component, (dst_h, dst_w)) for component in component_vecs]
+
+        components_key = [stage_key(options, ['margins', 'components'])]
+        self.components = self._stage(self.components, components_key, 'components', components)
+        component_vecs = [c.to_tuple() if isinstance(c, ColorArray) else c for c in self.components[1]]
+
+        for channel in range(3):
+            key = [self.samples[channel][0], components_key]
+            self.prods[channel] = self._stage(
+                self.prods[channel], key, 'project {}'.format(channel + 1),
+                lambda: project_prod_numpy(self.samples[channel][1].to_tuple(), component_vecs[channel]))
+
+        combined_key = [prod[0] for prod in self.prods]
+        self.combined = self._stage(self.combined, combined_key, 'combine',
+                                    lambda: sum_components_numpy([prod[1] for prod in self.prods], component_vecs))
+
+        def convert():
+            result = np.empty((dst_h, dst_w, 3), dtype=np.uint8)
+            for band_begin in range(0, dst_h, band_rows):
+                band_end = min(dst_h, band_begin + band_rows)
+                result[band_begin:band_end] = convert_combined_numpy(self.combined[1][band_begin:band_end], options)
+            return DecodedImage((dst_w, dst_h), result)
+
+        backward = dict(without=('rgb_to_col', 'rgb_to_col_batch'))
+        result_key = [self.combined[0], stage_key(options, ['colorspace'], **backward)]
+        self.result = self._stage(self.result, result_key, 'convert', convert)
+        return self.result[1]
+
+
+def output_size(img_size, popopts):
+    margins = popopts['margins']
+    return (margins['left'] + img_size[0] + margins['right'],
+            margins['top'] + img_size[1] + margins['bottom'])
+
+
 def run_options(img, popopts):
-    data = []
+    # `img` can be a `PIL.Image`, or a `DecodedImage` if it is used repeatedly.
+    return render(img, popopts).to_image()
+
+
+def render(img, popopts, jobs=1):
+    # Like `run_options`, but returns a `DecodedImage`, which avoids converting to `PIL.Image`.
+    # With `jobs` > 1, renders in that many worker processes.
+    img = DecodedImage.from_image(img)
+    if jobs > 1:
+        return render_parallel(img, popopts, jobs)
+    if resolve_engine(popopts) == 'numpy':
+        return run_options_numpy(img, popopts)
+    return run_options_scalar(img, popopts)
+
+
+def resolve_engine(popopts):
+    engine = popopts['engine']
+    if engine == 'auto':
+        return 'numpy' if np is not None else 'scalar'
+    elif engine == 'numpy' and np is None:
+        raise ValueError('Engine "numpy" requested, but NumPy is not installed')
+    elif engine not in ['scalar', 'numpy']:
+        raise ValueError('Unknown engine', engine)
+    return engine
+
+
+def render_band(img, popopts, row_begin, row_end, data):
+    # Renders the output rows `row_begin` to `row_end` (counting from the top margin)
+    # into `data`, a writable buffer of exactly that size.
+    if resolve_engine(popopts) == 'numpy':
+        dst_w = output_size(img.size, popopts)[0]
+        result = np.frombuffer(data, dtype=np.uint8).reshape(row_end - row_begin, dst_w, 3)
+        render_band_numpy(img, popopts, row_begin, row_end, result)
+    else:
+        pipeline = popopts if isinstance(popopts, Pipeline) else Pipeline(popopts)
+        render_band_scalar(img, pipeline, row_begin, row_end, data)
+
+
+def resolve_caches(popopts, img_w, img_h):
+    # Lets every registree fill in its '_cache' now, so that copies of `popopts`,
+    # e.g. in worker processes, all use the same values.
+    for key in ['distortion_1', 'distortion_2', 'distortion_3', 'components']:
+        plug_call(popopts, key, 'fn', 0, 0, img_w, img_h)
+
+
+# Per worker process of `render_parallel`: (shm_in, shm_out, img, popopts)
+_parallel_state = None
+
+
+def _parallel_init(shm_in_name, shm_out_name, img_size, popopts):
+    global _parallel_state
+    shm_in = multiprocessing.shared_memory.SharedMemory(name=shm_in_name)
+    shm_out = multiprocessing.shared_memory.SharedMemory(name=shm_out_name)
+    img = DecodedImage(img_size, shm_in.buf[:3 * img_size[0] * img_size[1]])
+    _parallel_state = (shm_in, shm_out, img, popopts)
+
+
+def _parallel_render_band(rows):
+    _, shm_out, img, popopts = _parallel_state
+    row_begin, row_end = rows
+    row_bytes = 3 * output_size(img.size, popopts)[0]
+    render_band(img, popopts, row_begin, row_end, shm_out.buf[row_begin * row_bytes:row_end * row_bytes])
+
+
+def render_parallel(img, popopts, jobs):
+    # Splits the output into bands of rows, and renders them in a pool of `jobs` processes.
+    # The input and output live in shared memory, and `popopts` is sent once per worker.
     img_w, img_h = img.size
-    dist_keys = ['distortion_{}'.format(i) for i in range(1, 3 + 1)]
-    for dst_y in range(-popopts['margins']['top'], img_h + popopts['margins']['bottom']):
-        for dst_x in range(-popopts['margins']['left'], img_w + popopts['margins']['right']):
+    dst_w, dst_h = output_size(img.size, popopts)
+    resolve_caches(popopts, img_w, img_h)
+    shm_in = multiprocessing.shared_memory.SharedMemory(create=True, size=len(img.data))
+    shm_out = multiprocessing.shared_memory.SharedMemory(create=True, size=3 * dst_w * dst_h)
+    try:
+        shm_in.buf[:len(img.data)] = img.data
+        # A few bands per worker, so that uneven bands even out:
+        band_rows = max(1, -(-dst_h // (4 * jobs)))
+        bands = [(row_begin, min(dst_h, row_begin + band_rows)) for row_begin in range(0, dst_h, band_rows)]
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=_parallel_init,
+                initargs=(shm_in.name, shm_out.name, img.size, popopts)) as executor:
+            for _ in executor.map(_parallel_render_band, bands):
+                pass  # Re-raises any exceptions
+        data = bytearray(shm_out.buf[:3 * dst_w * dst_h])
+    finally:
+        shm_in.close()
+        shm_in.unlink()
+        shm_out.close()
+        shm_out.unlink()
+    return DecodedImage((dst_w, dst_h), data)
+
+
+def run_options_scalar(img, popopts):
+    img = DecodedImage.from_image(img)
+    popopts = popopts if isinstance(popopts, Pipeline) else Pipeline(popopts)
+    dst_w, dst_h = output_size(img.size, popopts)
+    data = bytearray(3 * dst_w * dst_h)
+    render_band_scalar(img, popopts, 0, dst_h, data)
+    return DecodedImage((dst_w, dst_h), data)
+
+
+def render_band_scalar(img, pipeline, row_begin, row_end, data):
+    # Renders the output rows `row_begin` to `row_end` (counting from the top margin) into `data`.
+    # `pipeline` must be a `Pipeline`.
+    img_w, img_h = img.size
+    data_index = 0
+    top = pipeline['margins']['top']
+    const_dist_vecs, const_component_vecs = pipeline.constants(img_w, img_h)
+    distortions = [(lambda *args, value=value: value) if value is not None else distortion
+                   for value, distortion in zip(const_dist_vecs, pipeline.distortions)]
+    border, rgb_to_col, col_to_rgb = pipeline.border, pipeline.rgb_to_col, pipeline.col_to_rgb
+    # With nearest-neighbor, each sample is just some input pixel, so convert each one only once,
+    # when it's first needed.  The interpolation chooses among indices instead of colors.  The plane
+    # is flat (a, b, c) values, as a `Color` per pixel would take about 200 bytes:
+    interpolation, pixels, first_row = pipeline.interpolation, img.data, img.rows[0]
+    plane = None
+    if pipeline['interpolation'].get('fn') is interpolate_nearest_neighbor and \
+            len(pixels) // 3 <= COLORSPACE_PLANE_MAX_PIXELS:
+        plane, converted = array.array('d', bytes(8 * len(pixels))), bytearray(len(pixels) // 3)
+    wrap = wraps_around(pipeline)
+    # Constant components only need to be checked once:
+    check_components = const_component_vecs is None
+    for component in const_component_vecs or []:
+        assert -1e-6 < component.vec_length() - 1 < 1e-6, component
+    for dst_y in range(row_begin - top, row_end - top):
+        for dst_x in range(-pipeline['margins']['left'], img_w + pipeline['margins']['right']):
             # Determine from where we should read the data:
-            dist_vecs = [plug_call(popopts, dist_key, 'fn', dst_x, dst_y, img_w, img_h) for dist_key in dist_keys]
-            source_locs = [plug_call(popopts, 'border', 'fn', dst_x - dist_x, dst_y - dist_y, img_w, img_h) for dist_x, dist_y in dist_vecs]
+            dist_vecs = [distortion(dst_x, dst_y, img_w, img_h) for distortion in distortions]
+            source_locs = [border(dst_x - dist_x, dst_y - dist_y, img_w, img_h) for dist_x, dist_y in dist_vecs]
 
             # Make the data usable:
-            source_rgbs = [compute_rgb(img, src_x, src_y, popopts) for src_x, src_y in source_locs]
-            source_cols = [plug_call(popopts, 'colorspace', 'rgb_to_col', *rgb) for rgb in source_rgbs]
+            if plane is None:
+                source_rgbs = [compute_rgb_bound(img, src_x, src_y, interpolation, wrap) for src_x, src_y in source_locs]
+                source_abcs = [rgb_to_col(*rgb).abc for rgb in source_rgbs]
+            else:
+                source_abcs = []
+                for src_x, src_y in source_locs:
+                    # This is `compute_rgb_bound`:
+                    assert 0 <= src_x < img_w and 0 <= src_y < img_h
+                    x0, x1 = math.floor(src_x), upper_neighbor(src_x, img_w, wrap)
+                    y0, y1 = math.floor(src_y), upper_neighbor(src_y, img_h, wrap)
+                    row0, row1 = (y0 - first_row) * img_w, (y1 - first_row) * img_w
+                    index = interpolation(row0 + x0, row1 + x0, row0 + x1, row1 + x1, src_x - x0, src_y - y0)
+                    i = 3 * index
+                    if not converted[index]:
+                        plane[i], plane[i + 1], plane[i + 2] = rgb_to_col(pixels[i], pixels[i + 1], pixels[i + 2]).abc
+                        converted[index] = 1
+                    source_abcs.append((plane[i], plane[i + 1], plane[i + 2]))
 
             # Determine which components to use at this point:
-            component_vecs = plug_call(popopts, 'components', 'fn', dst_x, dst_y, img_w, img_h)
-
-            # Project onto the components we're actually interested in:
-            component_cols = [project_col(raw_col, component) for raw_col, component in zip(source_cols, component_vecs)]
-
-            # Combine:
-            result_col = sum(component_cols, Color.zero()).clip_length(1)
-            # `clip_length` is necessary as we're doing a component analysis
+            component_vecs = const_component_vecs or pipeline.components(dst_x, dst_y, img_w, img_h)
+
+            # Project onto the components we're actually interested in, and combine.
+            # This is `project_col` and `Color` arithmetic, written out to avoid allocations:
+            r0 = r1 = r2 = None
+            for (a, b, c), component in zip(source_abcs, component_vecs):
+                x, y, z = component.abc
+                if check_components:
+                    assert -1e-6 < math.sqrt(x * x + y * y + z * z) - 1 < 1e-6, component
+                assert -1 <= math.sqrt(a * a + b * b + c * c) - 1 < 1e-6, (a, b, c)
+                prod = a * x + b * y + c * z
+                if r0 is None:
+                    r0, r1, r2 = x * prod, y * prod, z * prod
+                else:
+                    r0, r1, r2 = r0 + x * prod, r1 + y * prod, r2 + z * prod
+
+            # This is `clip_length(1)`, which is necessary as we're doing a component analysis
             # of three *different* colors.  If all distortions were just identity,
             # i.e. no distortions at all, then no clipping would happen at all.
             # Therefore, clipping only happens when the involved values are extreme,
             # so clipping is basically the only reasonable method.
             # If you disagree, feel free to open up yet another 'registry'.
+            length = math.sqrt(r0 * r0 + r1 * r1 + r2 * r2)
+            if length > 1:
+                factor = 1 / length
+                r0, r1, r2 = r0 * factor, r1 * factor, r2 * factor
+            result_col = Color([r0, r1, r2])
 
             # Aaand done:
-            result_rgb = plug_call(popopts, 'colorspace', 'col_to_rgb', result_col)
-            data.append(tuple(result_rgb))
-
-    result = PIL.Image.new(
-        'RGB',
-        (popopts['margins']['left']+ img_w + popopts['margins']['right'],
-         popopts['margins']['top'] + img_h + popopts['margins']['bottom']))
-    # From experience it's faster to write everything into a list first,
-    # and then bulk-load it into the image.  I am aware that `putpixel` exists.
-    # TODO: Benchmark whether this is actually the case?
-    result.putdata(data)
-    return result
+            result_rgb = col_to_rgb(result_col)
+            data[data_index], data[data_index + 1], data[data_index + 2] = result_rgb
+            data_index += 3
+
+
+OPTION_REGISTRIES = {
+    'border': REGISTRY_BORDER,
+    'interpolation': REGISTRY_INTERPOLATION,
+    'colorspace': REGISTRY_COLORSPACE,
+    'components': REGISTRY_COMPONENTS,
+    'distortion_1': REGISTRY_DISTORTION,
+    'distortion_2': REGISTRY_DISTORTION,
+    'distortion_3': REGISTRY_DISTORTION,
+}
 
 
-def populate_options(raw_options):
+def populate_options(raw_options, resolve_names=True):
+    # With `resolve_names`, functions may be given as "module:name", which imports that module.
+    # Options from untrusted sources (e.g. the server) must not do that.
     assert isinstance(raw_options, dict), type(raw_options)
 
     # Fill-in the default values:
@@ -318,16 +1387,7 @@ def populate_options(raw_options):
         options['margins'].update(raw_options['margins'])
 
     # Expand all shortnames:
-    registries = {
-        'border': REGISTRY_BORDER,
-        'interpolation': REGISTRY_INTERPOLATION,
-        'colorspace': REGISTRY_COLORSPACE,
-        'components': REGISTRY_COMPONENTS,
-        'distortion_1': REGISTRY_DISTORTION,
-        'distortion_2': REGISTRY_DISTORTION,
-        'distortion_3': REGISTRY_DISTORTION,
-    }
-    for key, registry in registries.items():
+    for key, registry in OPTION_REGISTRIES.items():
         if key not in options and key.startswith('distortion_'):
             options[key] = options['distortion']  # No need to copy, thankfully
         if isinstance(options[key], str):
@@ -335,7 +1395,18 @@ def populate_options(raw_options):
             options[key] = base
         elif isinstance(options[key], dict):
             base = registry[options[key]['type']].copy()
+            for name in options[key]:
+                # Replacing a function also replaces its batch version (etc.), unless that is given, too:
+                for suffix in FUNCTION_SUFFIXES:
+                    if name + suffix not in options[key]:
+                        base.pop(name + suffix, None)
             base.update(options[key])
+            for name, value in base.items():
+                # Functions can also be given by name, see `options_to_json`:
+                if isinstance(value, str) and (callable(registry[base['type']].get(name)) or name.endswith(FUNCTION_SUFFIXES)):
+                    if not resolve_names:
+                        raise ValueError('Functions cannot be given by name here', key, name)
+                    base[name] = resolve_function(value)
             options[key] = base
         else:
             raise AssertionError('value for option {} has unexpected type {} (expected str or dict)'.format(key, type(options[key])))
@@ -346,28 +1417,1196 @@ def populate_options(raw_options):
     return options
 
 
-def run_arguments(options, force, verbose, file_in, file_out):
+def function_name(fn):
+    return '{}:{}'.format(fn.__module__, fn.__qualname__)
+
+
+def resolve_function(name):
+    # The inverse of `function_name`, e.g. 'mymodule:my_distortion'.
+    module_name, _, qualname = name.partition(':')
+    thing = importlib.import_module(module_name)
+    for part in qualname.split('.'):
+        thing = getattr(thing, part)
+    return thing
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items() if not k.startswith('_')}
+    if callable(value):
+        return function_name(value)
+    return value
+
+
+def options_to_json(popopts):
+    # The options-dict in JSON-compatible form, such that `populate_options` reproduces it exactly.
+    # Functions that come with the 'type' are left out, other functions are given by name.
+    # Caches are left out, too: they only depend on the seeds.
+    result = dict()
+    for key, value in popopts.items():
+        if key not in OPTION_REGISTRIES:
+            result[key] = _jsonable(value)
+            continue
+        registree = OPTION_REGISTRIES[key][value['type']]
+        entry = dict()
+        for name, v in value.items():
+            # A batch function (etc.) only comes with the 'type' if the plain function does, too:
+            plain_name = name
+            for suffix in FUNCTION_SUFFIXES:
+                if name.endswith(suffix):
+                    plain_name = name[:-len(suffix)]
+            if callable(v) and registree.get(name) is v and registree.get(plain_name) is value.get(plain_name):
+                continue
+            entry[name] = v
+        result[key] = _jsonable(entry)
+    return result
+
+
+class Pipeline(collections.abc.Mapping):
+    # The options-dict, compiled: Each stage's function comes with its context already bound, and
+    # stages that return the same everywhere are evaluated only once per input size.
+    # Behaves like a read-only options-dict, so it can be used wherever one is expected.
+    # Reusable for many images, picklable (if all functions are), and round-trips through `to_json`.
+    def __init__(self, popopts):
+        options = {key: dict(value) if isinstance(value, dict) else value for key, value in popopts.items()}
+        stages = dict(
+            border=bind_stage(options, 'border', 'fn'),
+            interpolation=bind_stage(options, 'interpolation', 'fn'),
+            rgb_to_col=bind_stage(options, 'colorspace', 'rgb_to_col'),
+            col_to_rgb=bind_stage(options, 'colorspace', 'col_to_rgb'),
+            components=bind_stage(options, 'components', 'fn'),
+        )
+        stages['distortions'] = tuple(bind_stage(options, key, 'fn')
+                                      for key in ['distortion_1', 'distortion_2', 'distortion_3'])
+        object.__setattr__(self, '_options', options)
+        object.__setattr__(self, '_constants', dict())
+        for name, stage in stages.items():
+            object.__setattr__(self, name, stage)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Pipeline is immutable')
+
+    def __getitem__(self, key):
+        return self._options[key]
+
+    def __iter__(self):
+        return iter(self._options)
+
+    def __len__(self):
+        return len(self._options)
+
+    def __reduce__(self):
+        return (Pipeline, (self._options,))
+
+    def constants(self, img_w, img_h):
+        # Returns (dist_vecs, component_vecs) for input images of this size.  Each distortion
+        # that returns the same everywhere is replaced by its value, otherwise it is None.
+        # Same for the components.  Telling these apart takes the batch functions, i.e. NumPy.
+        if (img_w, img_h) not in self._constants:
+            dist_vecs = [None] * 3
+            component_vecs = None
+            if np is not None:
+                for i, distortion in enumerate(self.distortions):
+                    if constant_batch_result(self, 'distortion_{}'.format(i + 1), img_w, img_h) is not None:
+                        dist_vecs[i] = distortion(0, 0, img_w, img_h)
+                if constant_batch_result(self, 'components', img_w, img_h) is not None:
+                    component_vecs = self.components(0, 0, img_w, img_h)
+            self._constants[(img_w, img_h)] = (dist_vecs, component_vecs)
+        return self._constants[(img_w, img_h)]
+
+    def to_json(self):
+        return json.dumps(options_to_json(self._options), indent=1, sort_keys=True)
+
+    @staticmethod
+    def from_json(text):
+        return compile_options(json.loads(text))
+
+
+def compile_options(raw_options, resolve_names=True):
+    # Like `populate_options`, but returns a `Pipeline`.
+    return Pipeline(populate_options(raw_options, resolve_names))
+
+
+class ImagePyramid:
+    # The input, and successively halved versions of it, down to about `min_dim` pixels.
+    # Built once, it provides inputs for previews of any size quickly; see `render_preview`.
+    def __init__(self, img, min_dim=64):
+        self.levels = [DecodedImage.from_image(img)]
+        while max(self.levels[-1].size) >= 2 * min_dim:
+            self.levels.append(DecodedImage.from_image(self.levels[-1].to_image().reduce(2)))
+
+    @property
+    def size(self):
+        return self.levels[0].size
+
+    def image(self, size):
+        # The input, scaled to `size`, from the smallest level that is at least as large.
+        level = next(level for level in reversed(self.levels) if level.size[0] >= size[0] and level.size[1] >= size[1])
+        if level.size == size:
+            return level
+        return DecodedImage.from_image(level.to_image().resize(size, PIL.Image.Resampling.BOX))
+
+
+def preview_size(full_size, max_dim):
+    # The size of a preview of an image of `full_size`, such that neither side exceeds `max_dim`.
+    w, h = full_size
+    scale = min(1, max_dim / max(w, h))
+    return (max(1, round(w * scale)), max(1, round(h * scale)))
+
+
+def preview_options(popopts, full_size, size):
+    # Options for rendering the input scaled to `size`, which look like the full render with `popopts`,
+    # scaled down: The margins are scaled, and the distortions and components are evaluated at the
+    # corresponding full-resolution coordinates (distortions are then scaled, too).  This takes care
+    # of all 'scale_type's, and of custom functions.
+    factor = (size[0] / full_size[0], size[1] / full_size[1])
+    options = dict(popopts)
+    options['margins'] = {side: round(margin * factor[0 if side in ['left', 'right'] else 1])
+                          for side, margin in popopts['margins'].items()}
+    for key in ['distortion_1', 'distortion_2', 'distortion_3', 'components']:
+        preview = PREVIEW_COMPONENTS if key == 'components' else PREVIEW_DISTORTION
+        scaled = dict(preview, inner=popopts[key], inner_size=tuple(full_size), factor=factor)
+        if 'fn_batch' not in popopts[key]:
+            # Calls the plain function anyway, and `constant_batch_result` must not take it for a batch function:
+            del scaled['fn_batch']
+        scaled['seed'] = popopts[key]['seed']
+        options[key] = scaled
+    return Pipeline(options)
+
+
+def render_preview(img, popopts, max_dim, jobs=1):
+    # Renders a preview, at most `max_dim` pixels wide and high (plus margins).  `img` may be an
+    # `ImagePyramid`, which makes repeated previews, e.g. with different options, much faster.
+    pyramid = img if isinstance(img, ImagePyramid) else ImagePyramid(img)
+    size = preview_size(pyramid.size, max_dim)
+    return render(pyramid.image(size), preview_options(popopts, pyramid.size, size), jobs)
+
+
+def render_progressive(img, popopts, max_dim=512, band_rows=256):
+    # Yields a preview as (None, preview) first, see `render_preview`.  Then, refines it by yielding
+    # the full-resolution output in bands of `band_rows` rows, as (row_begin, band).
+    pyramid = img if isinstance(img, ImagePyramid) else ImagePyramid(img)
+    yield None, render_preview(pyramid, popopts, max_dim)
+    img = pyramid.levels[0]
+    dst_w, dst_h = output_size(img.size, popopts)
+    for row_begin in range(0, dst_h, band_rows):
+        row_end = min(dst_h, row_begin + band_rows)
+        data = bytearray(3 * dst_w * (row_end - row_begin))
+        render_band(img, popopts, row_begin, row_end, data)
+        yield row_begin, DecodedImage((dst_w, row_end - row_begin), data)
+
+
+def render_animation(img, base_options, frame_options, jobs=1):
+    # Yields one frame (a `DecodedImage`) per entry of `frame_options`, rendered with
+    # `base_options` updated by that entry.  E.g. sweep the 'seed', or ramp up a distortion.
+    # The input is decoded and converted to the colorspace only once, and frames are
+    # rendered lazily, so only as many frames are in memory as the consumer holds on to.
+    img = DecodedImage.from_image(img)
+    for overrides in frame_options:
+        raw_options = dict(base_options)
+        raw_options.update(overrides)
+        popopts = compile_options(raw_options)
+        if np is not None and jobs <= 1:
+            img.keep_colorspace_plane(popopts)
+        yield render(img, popopts, jobs)
+
+
+def render_sequence(frames, popopts, jobs=1):
+    # Yields the rendered `DecodedImage` for each of `frames`, e.g. the frames of a video, all with
+    # the same options.  With NumPy, the `GatherMap` is computed once per frame size and reused.
+    gather_maps = dict()
+    for frame in frames:
+        frame = DecodedImage.from_image(frame)
+        if jobs > 1 or resolve_engine(popopts) != 'numpy':
+            yield render(frame, popopts, jobs)
+            continue
+        if frame.size not in gather_maps:
+            gather_maps[frame.size] = GatherMap(popopts, frame.size)
+        yield gather_maps[frame.size].render(frame)
+
+
+def write_animation(frames, file_out, duration=100, loop=0):
+    # Writes the `DecodedImage`s from the iterable `frames` as an animation; `duration` is per frame, in ms.
+    # GIFs are written frame by frame.  For other formats (e.g. APNG, WebP), PIL needs all frames at once:
+    # It goes through `append_images` more than once, so that must be a list.
+    frames = iter(frames)
+    first = next(frames)
+    if not file_out.lower().endswith('.gif'):
+        first.to_image().save(file_out, save_all=True, append_images=[frame.to_image() for frame in frames],
+                              duration=duration, loop=loop)
+        return
+    with open(file_out, 'wb') as fp:
+        for i, frame in enumerate(itertools.chain([first], frames)):
+            # Median cut takes much longer than rendering the frame, and isn't much better:
+            frame_img = frame.to_image().quantize(256, method=PIL.Image.Quantize.FASTOCTREE)
+            if i == 0:
+                header, _ = PIL.GifImagePlugin.getheader(frame_img, None, dict(loop=loop, duration=duration))
+                fp.writelines(header)
+            # Each frame brings its own palette:
+            fp.writelines(PIL.GifImagePlugin.getdata(frame_img, duration=duration, include_color_table=True))
+        fp.write(b';')  # GIF trailer
+
+
+def read_input(file_in, raw_size=None, max_pixels=None):
+    # `file_in` may be '-' for stdin, or a binary stream.  With `raw_size`, the input is raw 8-bit RGB
+    # instead of an image file.  Images with more than `max_pixels` are rejected before decoding.
+    if file_in == '-':
+        stream = io.BytesIO(sys.stdin.buffer.read())
+    elif isinstance(file_in, str):
+        stream = open(file_in, 'rb')
+    else:
+        stream = file_in
+    with stream:
+        if raw_size is not None:
+            w, h = raw_size
+            data = stream.read(3 * w * h)
+            if len(data) != 3 * w * h:
+                raise ValueError('Raw input too short', len(data), raw_size)
+            return DecodedImage(raw_size, data)
+        img = PIL.Image.open(stream)
+        if max_pixels is not None and img.size[0] * img.size[1] > max_pixels:
+            raise ValueError('Image too large', img.size, max_pixels)
+        img.load()
+        return DecodedImage.from_image(img)
+
+
+def read_raw_frames(stream, size):
+    # Yields one `DecodedImage` per `size` worth of raw 8-bit RGB from `stream`, until it ends.
+    w, h = size
+    while True:
+        data = stream.read(3 * w * h)
+        if not data:
+            return
+        if len(data) != 3 * w * h:
+            raise ValueError('Raw input ends in the middle of a frame', len(data), size)
+        yield DecodedImage(size, data)
+
+
+# Chroma subsampling of each Y4M colorspace, as divisors for (width, height).  None means grayscale.
+Y4M_CHROMA = {
+    '444': (1, 1),
+    '422': (2, 1),
+    '420': (2, 2),
+    '420jpeg': (2, 2),
+    '420paldv': (2, 2),
+    '420mpeg2': (2, 2),
+    'mono': None,
+}
+
+# Studio range ("limited", the default in Y4M) to full range, and back, for luma and chroma:
+Y4M_EXPAND_Y = [min(255, max(0, round((v - 16) * 255 / 219))) for v in range(256)]
+Y4M_EXPAND_C = [min(255, max(0, round((v - 128) * 255 / 224 + 128))) for v in range(256)]
+Y4M_SHRINK_Y = [round(v * 219 / 255 + 16) for v in range(256)]
+Y4M_SHRINK_C = [round((v - 128) * 224 / 255 + 128) for v in range(256)]
+
+
+class Y4MFormat:
+    # A YUV4MPEG2 stream, as written by e.g. `ffmpeg -f yuv4mpegpipe`.  Converts between its
+    # frames and `DecodedImage`s, using PIL's (BT.601) YCbCr, and chroma subsampling by resizing.
+    def __init__(self, header):
+        tokens = header.split()
+        if not tokens or tokens[0] != b'YUV4MPEG2':
+            raise ValueError('Not a Y4M stream', header[:20])
+        self.tokens = [token.decode() for token in tokens[1:]]
+        fields = {token[0]: token[1:] for token in self.tokens}
+        self.size = (int(fields['W']), int(fields['H']))
+        self.chroma = fields.get('C', '420jpeg')
+        if self.chroma not in Y4M_CHROMA:
+            raise ValueError('Unsupported Y4M colorspace', self.chroma)
+        self.full_range = 'XCOLORRANGE=FULL' in self.tokens
+
+    def header(self, size):
+        # The stream header for frames of size `size`, otherwise the same as the input.
+        tokens = [{'W': 'W{}'.format(size[0]), 'H': 'H{}'.format(size[1])}.get(token[0], token) for token in self.tokens]
+        return ' '.join(['YUV4MPEG2'] + tokens).encode() + b'\n'
+
+    def plane_sizes(self, size):
+        subsampling = Y4M_CHROMA[self.chroma]
+        if subsampling is None:
+            return [size]
+        chroma_size = (-(-size[0] // subsampling[0]), -(-size[1] // subsampling[1]))
+        return [size, chroma_size, chroma_size]
+
+    def read_frames(self, stream):
+        # Yields one `DecodedImage` per frame in `stream`, until it ends.
+        plane_sizes = self.plane_sizes(self.size)
+        frame_bytes = sum(w * h for w, h in plane_sizes)
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            if not line.startswith(b'FRAME'):
+                raise ValueError('Expected Y4M frame header', line[:20])
+            data = stream.read(frame_bytes)
+            if len(data) != frame_bytes:
+                raise ValueError('Y4M input ends in the middle of a frame', len(data), frame_bytes)
+            planes = []
+            for plane_size in plane_sizes:
+                plane_bytes = plane_size[0] * plane_size[1]
+                planes.append(PIL.Image.frombuffer('L', plane_size, data[:plane_bytes], 'raw', 'L', 0, 1))
+                data = data[plane_bytes:]
+            yield self.decode(planes)
+
+    def decode(self, planes):
+        if len(planes) == 1:
+            planes += [PIL.Image.new('L', self.size, 128)] * 2
+        planes = [plane if plane.size == self.size else plane.resize(self.size, PIL.Image.Resampling.BILINEAR)
+                  for plane in planes]
+        if not self.full_range:
+            planes = [planes[0].point(Y4M_EXPAND_Y)] + [plane.point(Y4M_EXPAND_C) for plane in planes[1:]]
+        return DecodedImage.from_image(PIL.Image.merge('YCbCr', planes))
+
+    def write_frame(self, img, stream):
+        planes = list(img.to_image().convert('YCbCr').split())
+        if not self.full_range:
+            planes = [planes[0].point(Y4M_SHRINK_Y)] + [plane.point(Y4M_SHRINK_C) for plane in planes[1:]]
+        stream.write(b'FRAME\n')
+        for plane, plane_size in zip(planes, self.plane_sizes(img.size)):
+            if plane.size != plane_size:
+                plane = plane.resize(plane_size, PIL.Image.Resampling.BOX)
+            stream.write(plane.tobytes())
+
+
+def run_sequence(popopts, force, file_in, file_out, raw_size=None, output_format='auto', jobs=1):
+    # `file_in` is either a directory of frames, rendered into the directory `file_out` under the
+    # same names, or a stream of frames: raw 8-bit RGB if `raw_size` is given, otherwise Y4M.
+    if os.path.isdir(file_in):
+        os.makedirs(file_out, exist_ok=True)
+        names = sorted(name for name in os.listdir(file_in) if os.path.isfile(os.path.join(file_in, name)))
+        paths_out = [os.path.join(file_out, name) for name in names]
+        existing = [path for path in paths_out if os.path.exists(path)]
+        if not force and existing:
+            print('Output file {} already exists, aborting.  Use "-f" to overwrite.'.format(existing[0]), file=sys.stderr)
+            exit(1)
+        frames = (read_input(os.path.join(file_in, name)) for name in names)
+        for path_out, result in zip(paths_out, render_sequence(frames, popopts, jobs)):
+            write_output(result, path_out, output_format)
+        return
+
+    if not force and file_out != '-' and os.path.exists(file_out):
+        print('Output file {} already exists, aborting.  Use "-f" to overwrite.'.format(file_out), file=sys.stderr)
+        exit(1)
+    stream_in = sys.stdin.buffer if file_in == '-' else open(file_in, 'rb')
+    stream_out = sys.stdout.buffer if file_out == '-' else open(file_out, 'wb')
+    try:
+        if raw_size is not None:
+            y4m = None
+            frames = read_raw_frames(stream_in, raw_size)
+        else:
+            y4m = Y4MFormat(stream_in.readline())
+            frames = y4m.read_frames(stream_in)
+        for i, result in enumerate(render_sequence(frames, popopts, jobs)):
+            if y4m is not None and output_format == 'auto':
+                if i == 0:
+                    stream_out.write(y4m.header(result.size))
+                y4m.write_frame(result, stream_out)
+            elif output_format == 'raw':
+                stream_out.write(result.data)
+            else:
+                result.to_ppm(stream_out)
+    finally:
+        if file_in != '-':
+            stream_in.close()
+        if file_out == '-':
+            stream_out.flush()
+        else:
+            stream_out.close()
+
+
+def write_output(result, file_out, output_format='auto'):
+    # `file_out` may be '-' for stdout.  'auto' lets PIL guess from the extension, or means PPM for stdout.
+    if output_format == 'auto':
+        if file_out != '-':
+            result.to_image().save(file_out)
+            return
+        output_format = 'ppm'
+    if file_out == '-':
+        stream = sys.stdout.buffer
+    else:
+        stream = open(file_out, 'wb')
+    try:
+        if output_format == 'ppm':
+            result.to_ppm(stream)
+        elif output_format == 'raw':
+            stream.write(result.data)
+        else:
+            raise ValueError('Unknown output format', output_format)
+    finally:
+        if file_out == '-':
+            stream.flush()
+        else:
+            stream.close()
+
+
+# Part of every `RenderCache` key.  Bump this whenever the same options start producing different images.
+RENDER_CACHE_VERSION = 1
+
+
+def canonical_options(popopts):
+    # The options in a canonical form (see `options_to_json`), leaving out everything that does not
+    # affect the result.  Returns None if that's not possible, e.g. for lambdas.
+    options = options_to_json(popopts)
+    del options['engine']  # All engines produce the same image
+    options.pop('distortion', None)  # Only used to populate 'distortion_1' etc.
+    if _has_anonymous_function(popopts):
+        return None
+    return json.dumps(options, sort_keys=True, separators=(',', ':'))
+
+
+def _has_anonymous_function(value):
+    # Whether there is a function like '<lambda>' or '<locals>', which is not identifiable by name.
+    if isinstance(value, collections.abc.Mapping):
+        return any(_has_anonymous_function(v) for k, v in value.items() if not k.startswith('_'))
+    if isinstance(value, (list, tuple)):
+        return any(_has_anonymous_function(v) for v in value)
+    return callable(value) and '<' in getattr(value, '__qualname__', '<')
+
+
+class RenderCache:
+    # Rendered images on disk, keyed by the input pixels and `canonical_options`.  Keeps at most
+    # `max_bytes`, evicting the least recently used.  Safe to share between processes: Entries are
+    # written to a temporary file and renamed into place, and vanishing entries are just misses.
+    # Assumes that functions given by name (see `options_to_json`) always return the same.
+    # Temporary files older than `stale_seconds` are from killed writers, and get removed.
+    def __init__(self, directory, max_bytes=1 << 30, stale_seconds=3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stale_seconds = stale_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, img, popopts):
+        # Returns None if the result can't be cached.
+        options = canonical_options(popopts)
+        if options is None:
+            return None
+        digest = hashlib.sha256('{}|{}|{}x{}|'.format(RENDER_CACHE_VERSION, options, *img.size).encode())
+        digest.update(img.data)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.ppm')
+
+    def get(self, key):
+        # Returns the cached `DecodedImage`, or None.
+        try:
+            with open(self.path(key), 'rb') as fp:
+                result = read_ppm(fp)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            os.utime(self.path(key))  # Recently used
+        except FileNotFoundError:
+            pass  # Evicted by someone else in the meantime
+        return result
+
+    def put(self, key, result):
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path(key)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                result.to_ppm(fp)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def entries(self):
+        # Returns a list of (mtime, size, path), oldest first.  Includes the temporary files.
+        entries = []
+        for subdir in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                if not name.endswith(('.ppm', '.tmp')):
+                    continue
+                path = os.path.join(subdir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # Evicted by someone else
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        stale = time.time() - self.stale_seconds
+        entries = []
+        for mtime, size, path in self.entries():
+            if path.endswith('.tmp') and mtime < stale:
+                self.remove(path)
+            else:
+                entries.append((mtime, size, path))
+        # Temporary files that are still being written count, but only entries can be evicted:
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path.endswith('.ppm'):
+                self.remove(path)
+                total -= size
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Evicted by someone else
+
+
+def cached_render(img, popopts, cache, jobs=1):
+    # Like `render`, but looks in the `RenderCache` `cache` first (unless it is None).
+    img = DecodedImage.from_image(img)
+    key = cache.key(img, popopts) if cache is not None else None
+    if key is not None:
+        result = cache.get(key)
+        if result is not None:
+            return result
+    result = render(img, popopts, jobs)
+    if key is not None:
+        cache.put(key, result)
+    return result
+
+
+def read_ppm(stream):
+    # Reads what `DecodedImage.to_ppm` writes.
+    header = stream.readline()
+    size = stream.readline().split()
+    depth = stream.readline()
+    if header != b'P6\n' or len(size) != 2 or depth != b'255\n':
+        raise ValueError('Not a PPM as written by tripmage')
+    size = (int(size[0]), int(size[1]))
+    data = stream.read()
+    if len(data) != 3 * size[0] * size[1]:
+        raise ValueError('PPM data has wrong length', len(data), size)
+    return DecodedImage(size, data)
+
+
+def read_ppm_header(stream):
+    # Reads the header of any binary 8-bit PPM, and leaves `stream` at the first pixel.  Returns the size.
+    tokens = []
+    token = b''
+    while len(tokens) < 4:
+        char = stream.read(1)
+        if not char:
+            raise ValueError('PPM header too short')
+        if char == b'#':
+            stream.readline()  # Comments end with the line
+            char = b'\n'
+        if not char.isspace():
+            token += char
+        elif token:
+            tokens.append(token)
+            token = b''
+    if tokens[0] != b'P6' or tokens[3] != b'255':
+        raise ValueError('Not a binary 8-bit PPM', tokens)
+    return (int(tokens[1]), int(tokens[2]))
+
+
+def distortion_bounds(options, entry, img_w, img_h):
+    # The largest absolute offsets the distortion `entry` may return, see 'fn_bounds'.
+    ctx = options[entry]
+    if 'max_offset' in ctx:
+        return tuple(ctx['max_offset'])
+    if 'fn_bounds' in ctx:
+        return ctx['fn_bounds'](img_w, img_h, ctx=ctx)
+    raise ValueError('Distortion has no bounds; set "max_offset" to [x, y] to stream it', entry, ctx['type'])
+
+
+def render_streaming(stream_in, size, popopts, stream_out, output_format='ppm', band_rows=None):
+    # Renders an input of `size` that arrives as raw 8-bit RGB rows on `stream_in`, and writes
+    # the output to `stream_out` as it goes ('ppm' or 'raw').  Only a window of input rows is kept
+    # in memory: The output band, plus as many rows as the distortions can reach, see 'fn_bounds'.
+    # Returns the largest number of input rows that were kept at once.
+    img_w, img_h = size
+    if popopts['border'].get('fn') is not border_snap:
+        raise ValueError('Streaming needs border "snap"', popopts['border']['type'])
+    pipeline = popopts if isinstance(popopts, Pipeline) else Pipeline(popopts)
+    max_dy = max(distortion_bounds(pipeline, 'distortion_{}'.format(i), img_w, img_h)[1] for i in range(1, 3 + 1))
+    reach = math.ceil(max_dy) + 1  # One more, against rounding
+    dst_w, dst_h = output_size(size, pipeline)
+    top = pipeline['margins']['top']
+    if band_rows is None:
+        # Each band needs `reach` more rows on either side, so with thinner bands, most input rows
+        # would be converted over and over again:
+        band_rows = max(1, BATCH_PIXELS // dst_w, 2 * reach)
+    row_bytes = 3 * img_w
+
+    if output_format == 'ppm':
+        stream_out.write('P6\n{} {}\n255\n'.format(dst_w, dst_h).encode())
+    elif output_format != 'raw':
+        raise ValueError('Cannot stream output format', output_format)
+    window = bytearray()
+    window_begin = window_end = 0
+    peak_rows = 0
+    out = bytearray(3 * dst_w * band_rows)
+    for row_begin in range(0, dst_h, band_rows):
+        row_end = min(dst_h, row_begin + band_rows)
+        need_begin = min(max(row_begin - top - reach, 0), img_h - 1)
+        need_end = min(max(row_end - 1 - top + reach, 0), img_h - 1) + 1
+        if need_begin > window_begin:
+            # A copy, instead of resizing a buffer that may still be referenced:
+            window = window[row_bytes * (need_begin - window_begin):]
+            window_begin = need_begin
+        if need_end > window_end:
+            data = stream_in.read(row_bytes * (need_end - window_end))
+            if len(data) != row_bytes * (need_end - window_end):
+                raise ValueError('Input too short', window_end + len(data) // row_bytes, size)
+            window += data
+            window_end = need_end
+        peak_rows = max(peak_rows, window_end - window_begin)
+        img = DecodedImage(size, window, rows=(window_begin, window_end))
+        band = memoryview(out)[:3 * dst_w * (row_end - row_begin)]
+        render_band(img, pipeline, row_begin, row_end, band)
+        stream_out.write(band)
+    return peak_rows
+
+
+def run_streaming(popopts, force, file_in, file_out, raw_size=None, output_format='auto'):
+    # `file_in` is a binary PPM, or raw 8-bit RGB if `raw_size` is given.  Writes PPM, unless 'raw' is asked for.
+    if not force and file_out != '-' and os.path.exists(file_out):
+        print('Output file {} already exists, aborting.  Use "-f" to overwrite.'.format(file_out), file=sys.stderr)
+        exit(1)
+    stream_in = sys.stdin.buffer if file_in == '-' else open(file_in, 'rb')
+    stream_out = sys.stdout.buffer if file_out == '-' else open(file_out, 'wb')
+    try:
+        size = raw_size if raw_size is not None else read_ppm_header(stream_in)
+        render_streaming(stream_in, size, popopts, stream_out, 'raw' if output_format == 'raw' else 'ppm')
+    finally:
+        if file_in != '-':
+            stream_in.close()
+        if file_out == '-':
+            stream_out.flush()
+        else:
+            stream_out.close()
+
+
+def parse_bytes(text):
+    # For `--cache-size`, e.g. '512M' or '2G'.
+    suffixes = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in suffixes:
+        return int(float(text[:-1]) * suffixes[text[-1]])
+    return int(text)
+
+
+def parse_size(text):
+    # For `--raw-size`, e.g. '640x480'.
+    w, h = text.lower().split('x')
+    return (int(w), int(h))
+
+
+def encode_output(result, output_format):
+    # Like `write_output`, but returns the bytes.  `output_format` is 'ppm', 'raw', or anything PIL can write.
+    if output_format == 'raw':
+        return bytes(result.data)
+    stream = io.BytesIO()
+    if output_format == 'ppm':
+        result.to_ppm(stream)
+    else:
+        result.to_image().save(stream, format=output_format)
+    return stream.getvalue()
+
+
+class LRUCache:
+    # A thread-safe dict that only keeps the most recently used entries, as long as their total
+    # `weigh(value)` stays within `size`.  By default, each entry weighs 1.
+    def __init__(self, size, weigh=None):
+        self.size = size
+        self.weigh = weigh if weigh is not None else (lambda value: 1)
+        self.weight = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, make):
+        # Returns the entry for `key`, calling `make()` to create it if necessary.
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        value = make()  # Outside the lock; creating the same entry twice is harmless.
+        weight = self.weigh(value)
+        with self.lock:
+            if key in self.entries:
+                self.weight -= self.weigh(self.entries.pop(key))
+            self.entries[key] = value
+            self.weight += weight
+            while self.weight > self.size:
+                _, evicted = self.entries.popitem(last=False)
+                self.weight -= self.weigh(evicted)
+        return value
+
+
+class RenderService:
+    # Renders jobs from a bounded queue in a pool of `workers` threads.  Stays warm between jobs:
+    # compiled options (see `Pipeline`), the tables of the colorspaces, and recently seen inputs
+    # (decoded, with their colorspace planes) are kept.  NumPy releases the GIL for most of the
+    # work, so threads do run in parallel.  (No process pools: Forking from all these threads is asking for trouble.)
+    # Jobs come from untrusted clients: Options cannot name functions (which would import modules), nor
+    # the slow scalar engine; inputs and outputs may have at most `max_pixels` each, and the kept inputs
+    # take at most `input_cache_bytes`.
+    def __init__(self, workers=2, queue_size=16, input_cache_bytes=1 << 30, render_cache=None, max_pixels=1 << 25):
+        self.render_cache = render_cache
+        self.max_pixels = max_pixels
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pipelines = LRUCache(64)
+        self.inputs = LRUCache(input_cache_bytes, weigh=self.input_bytes)
+        self.stats_lock = threading.Lock()
+        self.counts = collections.Counter()
+        # Of the most recent jobs, in seconds:
+        self.latencies = collections.deque(maxlen=1000)
+        self.waits = collections.deque(maxlen=1000)
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, options, input_bytes, output_format='png'):
+        # Queues a job, and returns a `concurrent.futures.Future` for the encoded output.
+        # `options` is the options-dict in JSON, just like for `--options`.
+        # Raises `queue.Full` if there are too many jobs waiting already.
+        future = concurrent.futures.Future()
+        try:
+            self.queue.put_nowait((options, input_bytes, output_format, future, time.monotonic()))
+        except queue.Full:
+            with self.stats_lock:
+                self.counts['rejected'] += 1
+            raise
+        return future
+
+    @staticmethod
+    def input_bytes(img):
+        # What a kept input may grow to, with all its colorspace planes.
+        return img.size[0] * img.size[1] * (3 + 24 * COLORSPACE_PLANES_KEPT)
+
+    def render(self, options, input_bytes, output_format='png'):
+        # Like `submit`, but waits for the result.
+        return self.submit(options, input_bytes, output_format).result()
+
+    def close(self):
+        # Lets the workers finish the queued jobs, then stops them.
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            options, input_bytes, output_format, future, submitted = job
+            started = time.monotonic()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                pipeline = self.pipelines.get(options, lambda: compile_options(json.loads(options), resolve_names=False))
+                if pipeline['engine'] not in ['auto', 'numpy']:
+                    raise ValueError('Engine not allowed here', pipeline['engine'])
+                img = self.inputs.get(hashlib.sha256(input_bytes).digest(),
+                                      lambda: read_input(io.BytesIO(input_bytes), max_pixels=self.max_pixels))
+                dst_w, dst_h = output_size(img.size, pipeline)
+                if dst_w * dst_h > self.max_pixels:
+                    raise ValueError('Output too large', (dst_w, dst_h), self.max_pixels)
+                if np is not None and resolve_engine(pipeline) == 'numpy':
+                    img.keep_colorspace_plane(pipeline)
+                result = cached_render(img, pipeline, self.render_cache)
+                outcome, value = 'done', encode_output(result, output_format)
+            except Exception as e:
+                outcome, value = 'failed', e
+            finished = time.monotonic()
+            with self.stats_lock:
+                self.counts[outcome] += 1
+                self.waits.append(started - submitted)
+                self.latencies.append(finished - submitted)
+            # Only now, so that the stats already include this job when its client sees the result:
+            if outcome == 'done':
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def stats(self):
+        # A JSON-compatible summary: queue, jobs, caches, and latencies (of the recent jobs, in ms).
+        def summary(seconds):
+            ms = sorted(1000 * s for s in seconds)
+            if not ms:
+                return None
+            return dict(mean=sum(ms) / len(ms), p50=ms[len(ms) // 2], p95=ms[int(len(ms) * 0.95)], max=ms[-1])
+        with self.stats_lock:
+            return dict(
+                queue_depth=self.queue.qsize(),
+                queue_size=self.queue.maxsize,
+                workers=len(self.threads),
+                jobs=dict(done=self.counts['done'], failed=self.counts['failed'], rejected=self.counts['rejected']),
+                cache=dict(pipeline_hits=self.pipelines.hits, pipeline_misses=self.pipelines.misses,
+                           input_hits=self.inputs.hits, input_misses=self.inputs.misses),
+                latency_ms=summary(self.latencies),
+                queue_wait_ms=summary(self.waits),
+            )
+
+
+RENDER_CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'gif': 'image/gif',
+    'ppm': 'image/x-portable-pixmap',
+    'raw': 'application/octet-stream',
+}
+
+
+class RenderRequestHandler(http.server.BaseHTTPRequestHandler):
+    # POST /render?options=<JSON>&format=<png|jpeg|webp|gif|ppm|raw> with the input image as the body,
+    # responds with the rendered image.  GET /stats responds with `RenderService.stats` in JSON.
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path != '/stats':
+            self.send_error(404)
+            return
+        self.respond(200, 'application/json', json.dumps(self.server.service.stats(), indent=1).encode())
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/render':
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(url.query)
+        options = query.get('options', ['{}'])[0]
+        output_format = query.get('format', ['png'])[0].lower()
+        if output_format not in RENDER_CONTENT_TYPES:
+            self.send_error(400, 'Unknown format')
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.send_error(400, 'Bad Content-Length')
+            return
+        if not 0 <= length <= self.server.max_upload:
+            self.send_error(413, 'Input larger than {} bytes'.format(self.server.max_upload))
+            return
+        body = self.rfile.read(length)
+        try:
+            future = self.server.service.submit(options, body, output_format)
+        except queue.Full:
+            self.send_error(503, 'Too many jobs queued')
+            return
+        try:
+            result = future.result()
+        except (ValueError, KeyError, AssertionError, PIL.UnidentifiedImageError, PIL.Image.DecompressionBombError) as e:
+            # Most likely bad options or a bad image:
+            self.send_error(400, repr(e)[:200])
+            return
+        except Exception as e:
+            self.send_error(500, repr(e)[:200])
+            return
+        self.respond(200, RENDER_CONTENT_TYPES[output_format], result)
+
+    def respond(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets have no client address.
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(address, service, quiet=False, max_upload=1 << 26):
+    # `address` is 'host:port', or 'unix:/path/to/socket'.  Uploads may have at most `max_upload` bytes.
+    if address.startswith('unix:'):
+        server = UnixHTTPServer(address[len('unix:'):], RenderRequestHandler)
+    else:
+        host, _, port = address.rpartition(':')
+        server = http.server.ThreadingHTTPServer((host, int(port)), RenderRequestHandler)
+    server.service = service
+    server.quiet = quiet
+    server.max_upload = max_upload
+    return server
+
+
+def run_server(address, workers, queue_size, render_cache=None):
+    service = RenderService(workers, queue_size, render_cache=render_cache)
+    server = make_server(address, service)
+    print('Serving on {}'.format(address), file=sys.stderr)
+    # Shut down cleanly when stopped as a daemon, too:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if address.startswith('unix:'):
+            os.remove(address[len('unix:'):])
+
+
+def batch_items(file_in, dir_out, base_options):
+    # Yields (path_in, path_out, options) for `render_batch`.  `file_in` is a directory, whose files are all
+    # rendered into `dir_out` under the same names, or a manifest: JSON lines like
+    #     {"input": "in/a.png", "output": "a.webp", "options": {"seed": "a"}}
+    # where "output" (relative to `dir_out`) defaults to the input's name, and "options" update `base_options`.
+    # A malformed line yields ('<manifest>:<line number>', None, the error), so that only that line fails.
+    if os.path.isdir(file_in):
+        for name in sorted(os.listdir(file_in)):
+            path_in = os.path.join(file_in, name)
+            if os.path.isfile(path_in):
+                yield path_in, os.path.join(dir_out, name), base_options
+        return
+    with open(file_in) as fp:
+        for line_number, line in enumerate(fp, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                options = dict(base_options)
+                options.update(entry.get('options', {}))
+                path_out = os.path.join(dir_out, entry.get('output', os.path.basename(entry['input'])))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                yield '{}:{}'.format(file_in, line_number), None, e
+                continue
+            yield entry['input'], path_out, options
+
+
+def _batch_render(popopts, img_size, data):
+    result = render(DecodedImage(img_size, data), popopts)
+    return result.size, bytes(result.data)
+
+
+def render_batch(items, jobs=1, io_threads=None, output_format='auto', force=False):
+    # Renders each (path_in, path_out, raw options) of `items`, e.g. from `batch_items`.  Decoding and encoding
+    # happen on `io_threads` threads, rendering in a pool of `jobs` processes (with `jobs` <= 1, on the
+    # threads themselves).  Each thread carries one file all the way, so at most `io_threads` decoded images
+    # exist at once, however many files are waiting.  For `Profile`, use `jobs=1, io_threads=1`.
+    # A file that fails (unreadable, output exists, worker crashed, ...) doesn't stop the others.
+    # Returns a summary: number of files, failures, and throughput.
+    if io_threads is None:
+        io_threads = jobs + 2  # Enough to keep all processes busy while others decode or encode
+    pipelines = LRUCache(64)
+    pool = [concurrent.futures.ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None]
+    pool_lock = threading.Lock()
+
+    def render_here(popopts, img):
+        result = render(img, popopts)
+        return result.size, result.data
+
+    def render_remote(popopts, img):
+        executor = pool[0]
+        try:
+            return executor.submit(_batch_render, popopts, img.size, bytes(img.data)).result()
+        except concurrent.futures.BrokenExecutor:
+            # A worker died, e.g. out of memory.  Files rendering in it fail, the rest go to a fresh pool:
+            with pool_lock:
+                if pool[0] is executor:
+                    pool[0] = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+            raise
+
+    def process(path_in, path_out, options):
+        if isinstance(options, Exception):
+            raise options  # From `batch_items`
+        if not force and os.path.exists(path_out):
+            raise FileExistsError('Output file already exists', path_out)
+        popopts = pipelines.get(json.dumps(options, sort_keys=True), lambda: compile_options(options))
+        img = read_input(path_in)
+        result_size, result_data = (render_remote if jobs > 1 else render_here)(popopts, img)
+        os.makedirs(os.path.dirname(path_out) or '.', exist_ok=True)
+        write_output(DecodedImage(result_size, result_data), path_out, output_format)
+        return img.size[0] * img.size[1]
+
+    start = time.perf_counter()
+    summary = dict(files=0, succeeded=0, failed=[], pixels=0)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=io_threads) as io_pool:
+            futures = [(path_in, io_pool.submit(process, path_in, path_out, options))
+                       for path_in, path_out, options in items]
+            for path_in, future in futures:
+                summary['files'] += 1
+                try:
+                    summary['pixels'] += future.result()
+                    summary['succeeded'] += 1
+                except Exception as e:
+                    summary['failed'].append(dict(input=path_in, error=repr(e)))
+    finally:
+        if pool[0] is not None:
+            pool[0].shutdown()
+    seconds = time.perf_counter() - start
+    summary.update(seconds=seconds, files_per_second=summary['files'] / seconds,
+                   megapixels_per_second=summary['pixels'] / seconds / 1e6)
+    return summary
+
+
+def _one_pixel(args, result):
+    return 1
+
+
+def _batch_pixels(args, result):
+    first = args[0][0] if isinstance(args[0], tuple) else args[0]
+    return int(np.size(first))
+
+
+def _band_pixels(args, result):
+    # For `render_constant_offsets_numpy`: Output rows times the output width.
+    row_begin, row_end, band = args[4:7]
+    return (row_end - row_begin) * band.shape[1]
+
+
+def _result_pixels(args, result):
+    return result.size[0] * result.size[1]
+
+
+def _argument_pixels(args, result):
+    return args[0].size[0] * args[0].size[1]
+
+
+class Profile:
+    # Counts calls, pixels, and (cumulative) time per stage, while active:
+    #     with tripmage.Profile() as profile:
+    #         result = tripmage.render(img, tripmage.compile_options(options))
+    #     print(profile.to_json())
+    # It does so by replacing the module's functions with timed versions, and putting them back
+    # afterwards, so without a `Profile` nothing is slowed down.  Only counts the current process,
+    # and only `Pipeline`s that are compiled while it is active.  Not thread-safe.
+    def __init__(self):
+        self.stages = dict()  # Stage name -> [calls, pixels, seconds]
+        self._saved = None
+
+    def record(self, name, pixels, seconds):
+        stats = self.stages.setdefault(name, [0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += pixels
+        stats[2] += seconds
+
+    def timed(self, name, fn, count_pixels):
+        perf_counter = time.perf_counter
+
+        @functools.wraps(fn)
+        def timed_fn(*args, **kwargs):
+            start = perf_counter()
+            result = fn(*args, **kwargs)
+            self.record(name, count_pixels(args, result), perf_counter() - start)
+            return result
+        return timed_fn
+
+    @staticmethod
+    def stage_name(options, entry, fn):
+        # E.g. 'distortion_1:static_random.fn_batch'
+        return '{}:{}.{}'.format(entry, options[entry]['type'], fn)
+
+    def __enter__(self):
+        assert self._saved is None, 'Profile is already active'
+        perf_counter = time.perf_counter
+        original_plug_call, original_batch_call, original_bind_stage = plug_call, batch_call, bind_stage
+
+        def profiled_plug_call(options, entry, fn, *args, **kwargs):
+            start = perf_counter()
+            result = original_plug_call(options, entry, fn, *args, **kwargs)
+            self.record(self.stage_name(options, entry, fn), 1, perf_counter() - start)
+            return result
+
+        def profiled_batch_call(options, entry, fn, *args):
+            start = perf_counter()
+            result = original_batch_call(options, entry, fn, *args)
+            # Without a batch version, `batch_call` calls the plain function for each element:
+            name = fn + '_batch' if fn + '_batch' in options[entry] else fn
+            self.record(self.stage_name(options, entry, name), _batch_pixels(args, result), perf_counter() - start)
+            return result
+
+        def profiled_bind_stage(options, entry, fn):
+            return self.timed(self.stage_name(options, entry, fn), original_bind_stage(options, entry, fn), _one_pixel)
+
+        patches = dict(
+            plug_call=profiled_plug_call,
+            batch_call=profiled_batch_call,
+            bind_stage=profiled_bind_stage,
+            read_rgb=self.timed('read_rgb', read_rgb, _one_pixel),
+            compute_rgb=self.timed('compute_rgb', compute_rgb, _one_pixel),
+            compute_rgb_bound=self.timed('compute_rgb_bound', compute_rgb_bound, _one_pixel),
+            project_col=self.timed('project_col', project_col, _one_pixel),
+            read_input=self.timed('decode', read_input, _result_pixels),
+            write_output=self.timed('encode', write_output, _argument_pixels),
+            encode_output=self.timed('encode', encode_output, _argument_pixels),
+        )
+        if np is not None:
+            patches['project_prod_numpy'] = self.timed('project_prod_numpy', project_prod_numpy, _batch_pixels)
+            # The fast path asks each stage once for its constant result, then just shifts the input around:
+            patches['render_constant_offsets_numpy'] = self.timed(
+                'constant_offsets', render_constant_offsets_numpy, _band_pixels)
+        module = globals()
+        self._saved = {name: module[name] for name in patches}
+        module.update(patches)
+        return self
+
+    def __exit__(self, *exc_info):
+        globals().update(self._saved)
+        self._saved = None
+
+    def report(self):
+        return {name: dict(calls=calls, pixels=pixels, seconds=seconds,
+                           pixels_per_second=pixels / seconds if seconds > 0 else None)
+                for name, (calls, pixels, seconds) in self.stages.items()}
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=1, sort_keys=True)
+
+
+def run_arguments(options, force, verbose, file_in, file_out, raw_size=None, output_format='auto', jobs=1,
+                  frames=None, frame_duration=100, sequence=False, render_cache=None, stream=False, batch=False,
+                  io_threads=None):
     options = json.loads(options)
-    populated_options = populate_options(options)
+    populated_options = compile_options(options)
+
+    if batch:
+        summary = render_batch(batch_items(file_in, file_out, options), jobs, io_threads, output_format, force)
+        if verbose:
+            print(populated_options.to_json())
+        print(json.dumps(summary, indent=1, sort_keys=True))
+        if summary['failed']:
+            exit(1)
+        return
+
+    if sequence or stream:
+        if sequence:
+            run_sequence(populated_options, force, file_in, file_out, raw_size, output_format, jobs)
+        else:
+            run_streaming(populated_options, force, file_in, file_out, raw_size, output_format)
+        if verbose:
+            report_file = sys.stderr if file_out == '-' else sys.stdout
+            print(populated_options.to_json(), file=report_file)
+        return
 
-    if not force and os.path.exists(file_out):
+    if not force and file_out != '-' and os.path.exists(file_out):
         print('Output file {} already exists, aborting.  Use "-f" to overwrite.'.format(file_out), file=sys.stderr)
         exit(1)
-    img = PIL.Image.open(file_in)
+    if frames is not None and file_out == '-':
+        print('Animations must be written to a file.', file=sys.stderr)
+        exit(1)
+    img = read_input(file_in, raw_size)
 
-    result_img = run_options(img, populated_options)
+    if frames is not None:
+        write_animation(render_animation(img, options, json.loads(frames), jobs), file_out, frame_duration)
+    else:
+        result = cached_render(img, populated_options, render_cache, jobs)
 
     if verbose:
-        def reprify(thing):
-            if isinstance(thing, (str, int, float)):
-                return thing
-            elif isinstance(thing, dict):
-                return {reprify(k): reprify(v) for k, v in thing.items()}
-            else:
-                return repr(thing)
-        print(json.dumps(reprify(populated_options), indent=1, sort_keys=True))
+        # Don't mix it into the image data:
+        report_file = sys.stderr if file_out == '-' else sys.stdout
+        print(populated_options.to_json(), file=report_file)
 
-    result_img.save(file_out)
+    if frames is None:
+        write_output(result, file_out, output_format)
 
 
 def build_parser(progname):
@@ -375,18 +2614,65 @@ def build_parser(progname):
         prog=progname, description="Make an image very trippy.")
     parser.add_argument('--options', default='{}', help='Options-dict in JSON')  # FIXME documentation?
     parser.add_argument('-f', '--force', action='store_true', help='Overwrite output file if exists')
-    parser.add_argument('-v', '--verbose', action='store_true', help='Report actual options-dict in JSON')
-    parser.add_argument('file_in', help='Input file, must be readable')
-    parser.add_argument('file_out', help='Output file, must not exist')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Report actual options-dict in JSON, which can be given to --options again')
+    parser.add_argument('--profile', action='store_true',
+                        help='Report calls, time, and pixels per second of each stage in JSON (ignores --jobs)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--raw-size', type=parse_size, metavar='WxH', help='Input is raw 8-bit RGB of this size')
+    parser.add_argument('--format', dest='output_format', choices=['auto', 'ppm', 'raw'], default='auto',
+                        help='Output format: "auto" guesses by extension, "ppm" is binary PPM, "raw" is raw 8-bit RGB')
+    parser.add_argument('--frames', help='Render an animation instead: JSON list of per-frame options, '
+                        'each updating the options-dict')
+    parser.add_argument('--frame-duration', type=int, default=100, help='Duration of each frame in ms')
+    parser.add_argument('--sequence', action='store_true', help='Render a sequence of frames, all with the same '
+                        'options: file_in is a directory of frames (file_out then is a directory, too), or a stream '
+                        'of raw 8-bit RGB frames (with --raw-size) or Y4M')
+    parser.add_argument('--stream', action='store_true', help='Render huge images in bounded memory: file_in is '
+                        'a binary PPM (or raw 8-bit RGB, with --raw-size), and the output is written as it is '
+                        'rendered, as PPM (or raw).  Needs border "snap", and distortions with known bounds')
+    parser.add_argument('--batch', action='store_true', help='Render many images: file_in is a directory (all '
+                        'files in it use the same options) or a manifest of JSON lines like {"input": "a.png", '
+                        '"output": "a.webp", "options": {...}}, and file_out is the output directory.  '
+                        'Reports a summary in JSON')
+    parser.add_argument('--serve', metavar='ADDRESS', help='Instead of rendering a file, serve renders over HTTP '
+                        'on ADDRESS, which is "host:port" or "unix:/path/to/socket"')
+    parser.add_argument('--workers', type=int, default=2, help='With --serve: Number of jobs rendered at once')
+    parser.add_argument('--queue-size', type=int, default=16, help='With --serve: Number of jobs that may wait')
+    parser.add_argument('--cache', metavar='DIR', help='Keep rendered images in DIR, and reuse them for the same '
+                        'input and options.  Can be shared by several processes')
+    parser.add_argument('--cache-size', type=parse_bytes, default=1 << 30, metavar='BYTES',
+                        help='Maximum size of the cache, e.g. "512M" (default: 1G)')
+    parser.add_argument('file_in', nargs='?', help='Input file, must be readable, or "-" for stdin')
+    parser.add_argument('file_out', nargs='?', help='Output file, must not exist, or "-" for stdout')
     return parser
 
 
 def run_argv(argv):
     parser = build_parser(argv[0])
     args = parser.parse_args(argv[1:])
-    
-    run_arguments(args.options, args.force, args.verbose,
-        args.file_in, args.file_out)
+    render_cache = RenderCache(args.cache, args.cache_size) if args.cache is not None else None
+    if args.serve is not None:
+        if args.jobs != 1:
+            parser.error('--jobs does not work with --serve, use --workers')
+        run_server(args.serve, args.workers, args.queue_size, render_cache)
+        return
+    if args.file_out is None:
+        parser.error('file_in and file_out are required')
+
+    if not args.profile:
+        run_arguments(args.options, args.force, args.verbose,
+            args.file_in, args.file_out, args.raw_size, args.output_format, args.jobs,
+            args.frames, args.frame_duration, args.sequence, render_cache, args.stream, args.batch)
+        return
+    # Worker processes would not report back, so everything happens in this one, and `Profile` is not
+    # thread-safe, so on one thread:
+    with Profile() as profile:
+        run_arguments(args.options, args.force, args.verbose,
+            args.file_in, args.file_out, args.raw_size, args.output_format, 1,
+            args.frames, args.frame_duration, args.sequence, render_cache, args.stream, args.batch, io_threads=1)
+    report_file = sys.stderr if args.file_out == '-' else sys.stdout
+    print(profile.to_json(), file=report_file)
 
 
 if __name__ == '__main__':